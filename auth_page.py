@@ -0,0 +1,47 @@
+import streamlit as st
+
+# ----- 認証画面 -----
+# 認証前は入力欄とボタンを描くだけなので、streamlit 以外は読み込まない。
+# 認証リストの取得（room_auth → showroom_client → requests）は初めて照合するときに import する。
+ROOM_LIST_URL = "https://mksoul-pro.com/showroom/file/room_list.csv"
+
+
+@st.cache_resource
+def get_room_index():
+    """全セッション共通の認証リスト（TTL 経過後はバックグラウンドで再取得）"""
+    from room_auth import RoomListIndex
+    return RoomListIndex(ROOM_LIST_URL)
+
+
+def show_auth_page():
+    """認証コードの入力欄を表示する（認証に成功したら画面全体を再実行する）"""
+    st.markdown("##### 🔑 認証コードを入力してください")
+    input_room_id = st.text_input(
+        "認証コードを入力してください:",
+        placeholder="",
+        type="password",
+        key="room_id_input"
+    )
+
+    if st.button("認証する"):
+        if input_room_id:
+            input_val = input_room_id.strip()
+            # 【追加】特殊コードの判定
+            if input_val == "mksp154851":
+                st.session_state.authenticated = True
+                st.session_state.is_admin = True
+                st.success("✅ 認証に成功しました。")
+                st.rerun()
+
+            try:
+                if input_val in get_room_index():
+                    st.session_state.authenticated = True
+                    st.session_state.is_admin = False
+                    st.success("✅ 認証に成功しました。ツールを利用できます。")
+                    st.rerun()
+                else:
+                    st.error("❌ 認証コードが無効です。正しい認証コードを入力してください。")
+            except Exception as e:
+                st.error(f"認証リストを取得できませんでした: {e}")
+        else:
+            st.warning("認証コードを入力してください。")
@@ -0,0 +1,209 @@
+import numpy as np
+import pandas as pd
+
+# ----- ファンデータ分析（詳細分析セクション用） -----
+ALERT_COLUMNS = ["順位", "ユーザー名", "種別", "前月", "前月Lv", "当月", "当月Lv", "変動"]
+
+
+class LevelMatrix:
+    """ユーザー×月のレベル行列と名前・アバターの付随テーブル
+
+    詳細分析の取得完了時に一度だけ作り、合算ランキング・急変動アラート・
+    ユーザー別推移のすべてをここから導出する（1ユーザー1か月1レコード前提。
+    重複した場合は後のレコードを採用する）。
+    """
+
+    def __init__(self, user_ids, months, levels, first_names, last_names, avatar_ids):
+        self.user_ids = user_ids          # int64[n_users]（昇順）
+        self.months = months              # list[str]（昇順）
+        self.levels = levels              # int16[n_users, n_months]（記録なしは0）
+        self.first_names = first_names    # 最初のレコードの名前（合算ランキング用）
+        self.last_names = last_names      # 最後のレコードの名前（アラート用）
+        self.avatar_ids = avatar_ids      # 最後のレコードのアバターID
+        self.row_of = {int(uid): i for i, uid in enumerate(user_ids)}
+        self._ranking = {}
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def ranking(self, n_months):
+        """合算ランキング（user_id, レベル合計値, ファン回数, ユーザー名, 平均レベル, 順位）"""
+        if n_months not in self._ranking:
+            totals = self.levels.sum(axis=1, dtype=np.int64)
+            df = pd.DataFrame({
+                'user_id': self.user_ids,
+                'レベル合計値': totals,
+                'ファン回数': (self.levels >= 10).sum(axis=1),
+                'ユーザー名': self.first_names,
+                '平均レベル': np.round(totals / max(n_months, 1), 1),
+            })
+            df['順位'] = df['レベル合計値'].rank(method='min', ascending=False).astype(int)
+            self._ranking[n_months] = df.sort_values('順位', kind="stable").reset_index(drop=True)
+        return self._ranking[n_months]
+
+    def ranks(self):
+        """行順に並んだ順位（合算値の多い順、同値は同順位）"""
+        totals = self.levels.sum(axis=1, dtype=np.int64)
+        return pd.Series(totals).rank(method='min', ascending=False).astype(int).to_numpy()
+
+    def user_history(self, user_id):
+        """全選択月のレベル推移（記録のない月は0）。未登録ユーザーは None"""
+        row = self.row_of.get(int(user_id))
+        if row is None:
+            return None
+        return pd.DataFrame({"ym": self.months, "level": self.levels[row].astype(int)})
+
+
+def build_level_matrix(full_df):
+    """取得済みの全レコード（user_id, ym, level, user_name, avatar_id）から LevelMatrix を作る"""
+    months = sorted(full_df['ym'].unique())
+    user_ids, user_pos = np.unique(full_df['user_id'].to_numpy(dtype=np.int64), return_inverse=True)
+    month_pos = np.searchsorted(months, full_df['ym'].to_numpy())
+
+    levels = np.zeros((len(user_ids), len(months)), dtype=np.int16)
+    # 同一セルへの重複代入は後勝ちになる
+    levels[user_pos, month_pos] = full_df['level'].fillna(0).to_numpy().astype(np.int16)
+
+    first = full_df.drop_duplicates('user_id', keep='first').set_index('user_id')
+    last = full_df.drop_duplicates('user_id', keep='last').set_index('user_id')
+    avatar = last['avatar_id'] if 'avatar_id' in last.columns else pd.Series(index=last.index, dtype=object)
+    return LevelMatrix(
+        user_ids=user_ids,
+        months=list(months),
+        levels=levels,
+        first_names=first['user_name'].reindex(user_ids).to_numpy(),
+        last_names=last['user_name'].reindex(user_ids).to_numpy(),
+        avatar_ids=avatar.reindex(user_ids).to_numpy(),
+    )
+
+
+def level_change_alerts(matrix, threshold):
+    """前月比でレベルが ±threshold 以上変動した (ユーザー, 月) を一覧にする
+
+    並び順は 順位の昇順 → 当月の降順（同順位はユーザーID順）。
+    """
+    months = np.asarray(matrix.months)
+    levels = matrix.levels.astype(np.int32)
+    if levels.shape[1] < 2:
+        return pd.DataFrame(columns=ALERT_COLUMNS)
+
+    prev_lv = levels[:, :-1]
+    curr_lv = levels[:, 1:]
+    diff = curr_lv - prev_lv
+    # 両月とも0（ずっと活動なし）は対象外
+    hit = (np.abs(diff) >= threshold) & ((prev_lv != 0) | (curr_lv != 0))
+    rows, cols = np.nonzero(hit)
+    if len(rows) == 0:
+        return pd.DataFrame(columns=ALERT_COLUMNS)
+
+    hit_diff = diff[rows, cols]
+    alert_df = pd.DataFrame({
+        "順位": matrix.ranks()[rows],
+        "ユーザー名": matrix.last_names[rows],
+        "種別": np.where(hit_diff > 0, "🚀大幅上昇", "🔻大幅下落"),
+        "前月": months[cols],
+        "前月Lv": prev_lv[rows, cols],
+        "当月": months[cols + 1],
+        "当月Lv": curr_lv[rows, cols],
+        "変動": hit_diff,
+        "_row": rows,
+        "_col": cols,
+    })
+    alert_df = alert_df.sort_values(by=["順位", "_col", "_row"], ascending=[True, False, True], kind="stable")
+    return alert_df.drop(columns=["_row", "_col"]).reset_index(drop=True)
+
+
+def top_competition_ranking(df, k=100, score='level', order='orig_order'):
+    """score 降順（同値は order 昇順）で競技順位を付け、順位 k 位以内の行だけを返す
+
+    同じ score は同順位、次の順位はその人数分飛ばす（1, 2, 2, 4 …）。
+    全件はソートせず、k 番目の score 以上の候補だけを並べ替える。
+    """
+    scores = df[score].to_numpy()
+    n = len(scores)
+    if n > k:
+        kth_score = np.partition(scores, n - k)[n - k]
+        candidates = df.iloc[np.flatnonzero(scores >= kth_score)]
+    else:
+        candidates = df
+    cand_scores = candidates[score].to_numpy()
+    sorted_idx = np.lexsort((candidates[order].to_numpy(), -cand_scores))
+    top = candidates.iloc[sorted_idx]
+
+    top_scores = cand_scores[sorted_idx]
+    is_new = np.r_[True, top_scores[1:] != top_scores[:-1]]
+    ranks = np.maximum.accumulate(np.where(is_new, np.arange(1, len(top_scores) + 1), 0))
+    top = top.assign(順位=ranks)
+    return top[top['順位'] <= k].reset_index(drop=True)
+
+
+FLOW_COLUMNS = ["年月", "ファン数", "新規", "継続", "復帰", "離脱", "定着率(%)"]
+
+
+def fan_flow(matrix):
+    """月ごとのファンの出入り（新規・継続・復帰・離脱）
+
+    ユーザー×月のレベル行列でレベルが1以上のセルを「その月のファン」とみなし、
+    月の列どうしの論理演算だけで数える。前月は選択月のうち1つ前の月を指す。
+    - 新規: 選択期間で初めてファンになった（最初の月は全員が新規）
+    - 継続: 前月もファンだった
+    - 復帰: 前月はファンではないが、それ以前にファンだったことがある
+    - 離脱: 前月はファンだったが、当月はファンではない
+    定着率は前月のファンのうち当月もファンだった割合。
+    """
+    present = matrix.levels > 0
+    if present.shape[1] == 0:
+        return pd.DataFrame(columns=FLOW_COLUMNS)
+    seen_before = np.zeros_like(present)
+    seen_before[:, 1:] = np.logical_or.accumulate(present, axis=1)[:, :-1]
+    prev = np.zeros_like(present)
+    prev[:, 1:] = present[:, :-1]
+
+    fans = present.sum(axis=0)
+    retained = (present & prev).sum(axis=0)
+    prev_fans = prev.sum(axis=0)
+    return pd.DataFrame({
+        "年月": matrix.months,
+        "ファン数": fans,
+        "新規": (present & ~seen_before).sum(axis=0),
+        "継続": retained,
+        "復帰": (present & ~prev & seen_before).sum(axis=0),
+        "離脱": (prev & ~present).sum(axis=0),
+        "定着率(%)": np.round(np.divide(retained * 100, prev_fans, out=np.full(len(fans), np.nan),
+                                      where=prev_fans > 0), 1),
+    })
+
+
+COHORT_COLUMNS = ["初回月", "経過月数", "対象月", "コホート人数", "ファン数", "定着率(%)"]
+
+
+def retention_cohorts(matrix):
+    """初めてファンになった月（コホート）ごとの定着率
+
+    コホート人数は初回月のファン数、ファン数は k か月後（選択月で k 個後）もファンだった人数。
+    ファンだったセルを (初回月, 経過月数) ごとに bincount で一括集計する。
+    """
+    present = matrix.levels > 0
+    n_months = present.shape[1]
+    rows, cols = np.nonzero(present)
+    if len(rows) == 0:
+        return pd.DataFrame(columns=COHORT_COLUMNS)
+    first = present.argmax(axis=1)
+    offsets = cols - first[rows]
+    counts = np.bincount(first[rows] * n_months + offsets, minlength=n_months * n_months)
+    counts = counts.reshape(n_months, n_months)
+
+    # (初回月, 経過月数) のうち選択期間に収まる組み合わせ
+    cohort, offset = np.nonzero(np.arange(n_months)[:, None] + np.arange(n_months)[None, :] < n_months)
+    sizes = counts[:, 0]
+    keep = sizes[cohort] > 0
+    cohort, offset = cohort[keep], offset[keep]
+    months = np.asarray(matrix.months)
+    return pd.DataFrame({
+        "初回月": months[cohort],
+        "経過月数": offset,
+        "対象月": months[cohort + offset],
+        "コホート人数": sizes[cohort],
+        "ファン数": counts[cohort, offset],
+        "定着率(%)": np.round(counts[cohort, offset] * 100 / sizes[cohort], 1),
+    })
@@ -0,0 +1,223 @@
+"""SHOWROOM ファンリストをブラウザを使わずに一括取得するコマンド
+
+例:
+    python fan_batch.py --rooms 154851 123456 --months 202401 202402 --out output
+    python fan_batch.py --rooms-file rooms.txt --months 202401 202402 --jobs 4 --format csv
+    python fan_batch.py --rooms 154851 --months 202401 --telemetry output/telemetry.json
+    python fan_batch.py --rooms 154851 --months 202401 202402 --parquet
+    python fan_batch.py --rooms 154851 --months 202401 202402 --compression lzma
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from zipfile import ZipFile
+
+import showroom_client
+import fan_parquet
+from fan_completeness import completeness_report, incomplete_months
+from fan_export import COMPRESSION_CODECS, DEFAULT_COMPRESSION, StreamingZipExport
+from fan_fetcher import DEFAULT_MAX_WORKERS, crawl_months, get_headers, sync_headers
+from fan_telemetry import Telemetry
+
+DEFAULT_JOBS = 2
+
+
+def export_room(room_id, months, out_dir, fmt="zip", max_workers=DEFAULT_MAX_WORKERS, use_cache=True,
+                incremental=False, telemetry=None, parquet=False, compression=DEFAULT_COMPRESSION,
+                compresslevel=None):
+    """1ルーム分を取得し、アプリと同じ ZIP（または展開済みCSV）を out_dir へ書き出す
+
+    incremental=True なら前回保存分と件数を比較し、変化した月だけをクロールする。
+    telemetry（fan_telemetry.Telemetry）を渡すとリクエストと処理段階の所要時間を記録する。
+    parquet=True なら out_dir/active_fans_<room_id>_parquet/ に Parquet データセットも書き出す。
+    compression / compresslevel: ZIP の圧縮形式（fan_export.COMPRESSION_CODECS のキー）とレベル
+
+    戻り値: 結果サマリの dict
+    """
+    started = time.time()
+    stats = showroom_client.new_stats()
+
+    def timed(name):
+        return telemetry.stage(f"{room_id}: {name}") if telemetry is not None else nullcontext()
+
+    with timed("先頭ページ取得"):
+        if incremental:
+            headers, _, changed = sync_headers(room_id, months, max_workers=max_workers,
+                                                           stats=stats, telemetry=telemetry)
+        else:
+            headers, _ = get_headers(room_id, months, use_cache=use_cache, max_workers=max_workers,
+                                                 stats=stats, telemetry=telemetry)
+            changed = None
+    month_counts = {m: headers.get(m, {}).get("count", 0) for m in months}
+    # 先頭ページが取れなかった月は件数が分からないためクロールしない（空の月をキャッシュに残さない）
+    # 差分更新で前回の先頭ページに代用できた月は headers に含まれるため、失敗として扱わない
+    crawl_counts = {m: c for m, c in month_counts.items() if m in headers}
+    header_failed = [m for m in months if m not in headers]
+
+    os.makedirs(out_dir, exist_ok=True)
+    zip_path = os.path.join(out_dir, f"active_fans_{room_id}.zip")
+    tmp_fd, tmp_path = tempfile.mkstemp(prefix=f"active_fans_{room_id}_", suffix=".zip", dir=out_dir)
+    parquet_path = os.path.join(out_dir, f"active_fans_{room_id}_parquet") if parquet else None
+    parquet_tmp = tempfile.mkdtemp(prefix=f"active_fans_{room_id}_parquet_", dir=out_dir) if parquet else None
+    try:
+        with os.fdopen(tmp_fd, "wb") as fp:
+            export = StreamingZipExport(room_id, months, fileobj=fp, compression=compression,
+                                        compresslevel=compresslevel)
+            for m, c in month_counts.items():
+                export.expect(m, c)
+            parquet_writer = fan_parquet.ParquetDatasetWriter(parquet_tmp) if parquet else None
+
+            def on_page(ym, offset, users):
+                export.add_page(ym, offset, users)
+                if parquet_writer is not None:
+                    parquet_writer.add_page(ym, offset, users)
+
+            with timed("全ページ取得・月別CSV書き込み"):
+                month_users, failed = crawl_months(room_id, crawl_counts, use_cache=use_cache,
+                                                   on_page=on_page, max_workers=max_workers,
+                                                   stats=stats, telemetry=telemetry)
+            with timed("完全性チェック"):
+                missing = {}
+                for ym, offset, limit, _ in failed:
+                    missing.setdefault(ym, []).append((offset, limit))
+                completeness = completeness_report(month_counts, month_users, missing, header_failed=header_failed)
+            if parquet_writer is not None:
+                with timed("Parquet書き出し"):
+                    parquet_writer.close(merge_rows=export.merge_rows())
+            with timed("ZIP作成（マージCSV含む）"):
+                export.finish(completeness=completeness)
+            fans = len(export.agg)
+
+        if fmt == "csv":
+            room_dir = os.path.join(out_dir, str(room_id))
+            with ZipFile(tmp_path) as zf:
+                zf.extractall(room_dir)
+            os.remove(tmp_path)
+            output = room_dir
+        else:
+            os.replace(tmp_path, zip_path)
+            output = zip_path
+        if parquet:
+            shutil.rmtree(parquet_path, ignore_errors=True)
+            os.replace(parquet_tmp, parquet_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        if parquet_tmp is not None:
+            shutil.rmtree(parquet_tmp, ignore_errors=True)
+        raise
+
+    return {
+        "room_id": room_id,
+        "output": output,
+        "months": len(months),
+        "fans": fans,
+        "failed_months": sorted(set(header_failed + [f[0] for f in failed])),
+        "failed_pages": len(failed),
+        "incomplete_months": incomplete_months(completeness),
+        "crawled_months": sorted(changed) if changed is not None else None,
+        "parquet": parquet_path,
+        "requests": stats["requests"],
+        "retries": stats["retries"],
+        "seconds": round(time.time() - started, 2),
+    }
+
+
+def export_rooms(room_ids, months, out_dir, jobs=DEFAULT_JOBS, **kwargs):
+    """複数ルームを最大 jobs 件ずつ並行して書き出す。ルーム単位の例外は結果に含めて返す"""
+    results = []
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        futures = {pool.submit(export_room, rid, months, out_dir, **kwargs): rid for rid in room_ids}
+        for fut in as_completed(futures):
+            rid = futures[fut]
+            try:
+                results.append(fut.result())
+            except Exception as e:
+                results.append({"room_id": rid, "error": str(e)})
+    order = {rid: i for i, rid in enumerate(room_ids)}
+    results.sort(key=lambda r: order[r["room_id"]])
+    return results
+
+
+def _read_rooms_file(path):
+    with open(path, encoding="utf-8") as f:
+        return [line.split(",")[0].strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def _valid_month(value):
+    if len(value) != 6 or not value.isdigit() or not 1 <= int(value[4:]) <= 12:
+        raise argparse.ArgumentTypeError(f"YYYYMM 形式で指定してください: {value}")
+    return value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SHOWROOM アクティブファンリストの一括取得")
+    parser.add_argument("--rooms", nargs="*", default=[], help="ルームID（複数指定可）")
+    parser.add_argument("--rooms-file", help="ルームIDを1行1件で記載したファイル（CSVの場合は1列目）")
+    parser.add_argument("--months", nargs="+", required=True, type=_valid_month, help="対象月 YYYYMM（複数指定可）")
+    parser.add_argument("--out", default="output", help="出力ディレクトリ（既定: output）")
+    parser.add_argument("--format", choices=["zip", "csv"], default="zip", help="zip: ルームごとのZIP / csv: ルームごとのフォルダへ展開")
+    parser.add_argument("--jobs", type=int, default=DEFAULT_JOBS, help=f"同時に処理するルーム数（既定: {DEFAULT_JOBS}）")
+    parser.add_argument("--workers", type=int, default=DEFAULT_MAX_WORKERS, help=f"1ルームあたりの同時リクエスト数（既定: {DEFAULT_MAX_WORKERS}）")
+    parser.add_argument("--no-cache", action="store_true", help="ディスクキャッシュを使わずに取得する")
+    parser.add_argument("--incremental", action="store_true",
+                        help="前回取得分と各月の件数を比較し、変化した月だけを再取得する")
+    parser.add_argument("--parquet", action="store_true",
+                        help="ZIP/CSV に加えて Parquet データセット（月別パーティション + マージ集計）も書き出す")
+    parser.add_argument("--compression", choices=list(COMPRESSION_CODECS), default=DEFAULT_COMPRESSION,
+                        help=f"ZIP の圧縮形式（既定: {DEFAULT_COMPRESSION}。OS標準の展開機能で開けるのは deflate と stored）")
+    parser.add_argument("--compress-level", type=int, metavar="N",
+                        help="圧縮レベル（deflate: 0-9 / bzip2: 1-9。未指定なら形式ごとの既定値）")
+    parser.add_argument("--telemetry", metavar="PATH",
+                        help="リクエスト・処理段階ごとの計測ログの保存先（拡張子 .csv ならCSV、それ以外はJSON）")
+    args = parser.parse_args(argv)
+
+    room_ids = list(args.rooms)
+    if args.rooms_file:
+        room_ids += _read_rooms_file(args.rooms_file)
+    room_ids = list(dict.fromkeys(room_ids))
+    if not room_ids:
+        parser.error("--rooms または --rooms-file でルームIDを指定してください。")
+    if args.parquet and not fan_parquet.available():
+        parser.error("--parquet には pyarrow が必要です（pip install pyarrow）")
+
+    telemetry = Telemetry("fan_batch") if args.telemetry else None
+    results = export_rooms(room_ids, args.months, args.out, jobs=args.jobs, fmt=args.format,
+                           max_workers=args.workers, use_cache=not args.no_cache,
+                           incremental=args.incremental, telemetry=telemetry, parquet=args.parquet,
+                           compression=args.compression, compresslevel=args.compress_level)
+
+    exit_code = 0
+    for r in results:
+        if "error" in r:
+            exit_code = 1
+            print(f"[NG] {r['room_id']}: {r['error']}", file=sys.stderr)
+            continue
+        if r["failed_months"]:
+            exit_code = 1
+        status = "OK" if not r["failed_months"] else "一部欠損"
+        crawled = f"再取得 {len(r['crawled_months'])} か月, " if r["crawled_months"] is not None else ""
+        print(f"[{status}] {r['room_id']}: {r['fans']} 人 / {r['months']} か月 -> {r['output']} "
+              f"({crawled}リクエスト {r['requests']} 件, 再試行 {r['retries']} 回, {r['seconds']} 秒)")
+        if r["parquet"]:
+            print(f"       Parquet: {r['parquet']}")
+        if r["failed_months"]:
+            print(f"       取得失敗の月: {', '.join(r['failed_months'])}", file=sys.stderr)
+        mismatched = [m for m in r["incomplete_months"] if m not in r["failed_months"]]
+        if mismatched:
+            print(f"       count と取得件数が一致しない月: {', '.join(mismatched)}", file=sys.stderr)
+    if telemetry is not None:
+        telemetry.save(args.telemetry)
+        summary = telemetry.summary()
+        print(f"計測ログ: {args.telemetry}（リクエスト {summary['requests']} 件, "
+              f"レイテンシ p95 {summary['latency_p95_sec']} 秒, 取得できなかったページ {summary['skipped_pages']} 件）")
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
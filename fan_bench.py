@@ -0,0 +1,333 @@
+"""ローカルのスタブサーバーに対して取得〜集計〜ZIP作成までの処理時間を計測するベンチマーク
+
+SHOWROOM の API には接続せず、api/active_fan/users と同じ形のレスポンスを返すスタブを起動し、
+ファン数（500 / 5,000 / 50,000）× 月数（1 / 6 / 24）の合成データで各段階を計測する。
+結果はコミット間で比較できるよう JSON に保存でき、--compare で前回の結果との比を表示する。
+
+例:
+    python fan_bench.py
+    python fan_bench.py --sizes 500 5000 --months 1 6 --repeat 3
+    python fan_bench.py --json bench_base.json
+    python fan_bench.py --compare bench_base.json --out bench_output.txt
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+from tabulate import tabulate
+
+from fan_analysis import build_level_matrix, level_change_alerts, top_competition_ranking
+from fan_export import DEFAULT_COMPRESSION, StreamingZipExport
+from fan_fetcher import DEFAULT_MAX_WORKERS, DEFAULT_RATE_PER_SEC, fetch_headers, fetch_months
+from fan_records import NameTable, records_frame
+from fan_table import build_table_html
+from fan_telemetry import Telemetry
+from fan_throttle import AdaptiveController
+
+DEFAULT_SIZES = (500, 5000, 50000)
+DEFAULT_MONTHS = (1, 6, 24)
+DEFAULT_MAX_LIMIT = 1000       # スタブが1ページで返す最大件数
+DEFAULT_ALERT_THRESHOLD = 7    # 画面の「検知しきい値」の既定値
+MERGE_TOP_N = 1000
+RENDER_ROWS = 100
+LAST_MONTH = (2025, 12)        # 合成データの最終月（締め済みの月）
+REGRESSION_RATIO = 1.2         # --compare でこの比を超えた段階を遅化として扱う
+
+STAGES = [
+    # (段階名, 表の見出し)
+    ("crawl", "取得"),
+    ("frame", "行データ作成"),
+    ("ranking", "合算ランキング"),
+    ("alerts", "急変動アラート"),
+    ("merge", "マージ集計"),
+    ("render", f"上位{RENDER_ROWS}件描画"),
+    ("zip", "ZIP作成"),
+]
+
+# 画面のマージ集計表と同じ列構成（アバターは画像タグになる）
+_RENDER_COLUMNS = [
+    {"key": "順位", "label": "順位", "td_style": "text-align:center;"},
+    {"key": "avatar_id", "label": "アバター", "td_style": "text-align:center;", "format": "avatar"},
+    {"key": "level", "label": "レベル合計値", "td_style": "text-align:center;"},
+    {"key": "user_name", "label": "ユーザー名", "td_style": "text-align:left; padding-left:8px;"},
+]
+
+
+# ----- 合成データ -----
+def month_labels(n_months, last=LAST_MONTH):
+    year, month = last
+    labels = []
+    for _ in range(n_months):
+        labels.append(f"{year}{month:02d}")
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return labels[::-1]
+
+
+def synthetic_room(fans, months, seed=0):
+    """1ルーム分の月別ユーザー {ym: [JSON文字列, ...]}（レベル降順）を作る
+
+    毎月およそ7割が前月から残り、残りは新規ユーザーに入れ替わる。
+    レベルは低い値ほど多い分布、名前には日本語・記号・HTMLの特殊文字を混ぜる。
+    """
+    rng = random.Random(f"{seed}:{fans}:{len(months)}")
+    next_id = 1000000
+    current = []
+    result = {}
+    for ym in months:
+        kept = rng.sample(current, int(len(current) * 0.7)) if current else []
+        new = fans - len(kept)
+        current = kept + list(range(next_id, next_id + new))
+        next_id += new
+        users = []
+        for uid in current:
+            level = min(70, 1 + int(rng.expovariate(1 / 8)))
+            users.append((level, uid))
+        users.sort(key=lambda u: (-u[0], u[1]))
+        result[ym] = [
+            json.dumps({
+                "avatar_id": uid % 1000, "level": level, "title_id": level // 5,
+                "user_id": uid, "user_name": f"ファン{uid % 9973}<{uid % 7}>&",
+            }, ensure_ascii=False)
+            for level, uid in users
+        ]
+    return result
+
+
+# ----- スタブサーバー -----
+class _StubHandler(BaseHTTPRequestHandler):
+    rooms = {}                  # {room_id: {ym: [JSON文字列, ...]}}
+    max_limit = DEFAULT_MAX_LIMIT
+    failures = {}               # {(room_id, ym, offset): [ステータス, ...]} 先頭から1回ずつ返す（テスト用）
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        query = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        users = self.rooms.get(query.get("room_id"), {}).get(query.get("ym"), [])
+        offset = int(query.get("offset", 0))
+        statuses = self.failures.get((query.get("room_id"), query.get("ym"), offset))
+        if statuses:
+            self.send_response(statuses.pop(0))
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        limit = min(int(query.get("limit", 50)), self.max_limit)
+        count = len(users)
+        body = (
+            f'{{"count": {count}, "total_user_count": {count}, "fan_power": {count * 3}, '
+            f'"fan_name": "ベンチ", "users": [{", ".join(users[offset:offset + limit])}]}}'
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_stub(max_limit=DEFAULT_MAX_LIMIT):
+    """スタブサーバーを起動して (server, api/active_fan/users のURL) を返す"""
+    handler = type("StubHandler", (_StubHandler,), {"rooms": {}, "max_limit": max_limit, "failures": {}})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/api/active_fan/users"
+
+
+# ----- 計測 -----
+def run_pipeline(base_url, room_id, months, max_workers=DEFAULT_MAX_WORKERS, rate_per_sec=DEFAULT_RATE_PER_SEC,
+                 compression=DEFAULT_COMPRESSION):
+    """アプリと同じ順に取得・分析・ZIP作成を行い、段階ごとの秒数を Telemetry に記録して返す
+
+    キャッシュ・学習済みのページサイズは使わない（毎回ページサイズの計測から始める）。
+    """
+    telemetry = Telemetry(f"bench {room_id}")
+    with tempfile.TemporaryDirectory(prefix="fan_bench_") as tmp_dir:
+        controller = AdaptiveController(path=os.path.join(tmp_dir, "throttle.json"))
+        kwargs = {"base_url": base_url, "max_workers": max_workers, "rate_per_sec": rate_per_sec,
+                  "controller": controller, "telemetry": telemetry}
+
+        with telemetry.stage("crawl"):
+            headers, _ = fetch_headers(room_id, months, **kwargs)
+            month_counts = {ym: headers.get(ym, {}).get("count", 0) for ym in months}
+            # ページは届いた時点で FanRecords に詰め替えられる（アプリと同じ）
+            records, _ = fetch_months(room_id, month_counts, names=NameTable(), **kwargs)
+
+        with telemetry.stage("frame"):
+            frame = records_frame(records)
+
+        with telemetry.stage("ranking"):
+            matrix = build_level_matrix(frame)
+            matrix.ranking(len(months))
+
+        with telemetry.stage("alerts"):
+            if len(months) >= 2:
+                level_change_alerts(matrix, DEFAULT_ALERT_THRESHOLD)
+
+        with telemetry.stage("zip"):
+            export = StreamingZipExport(room_id, months, compression=compression)
+            for ym in months:
+                export.add_page(ym, 0, records[ym])
+                export.close_month(ym)
+            zip_file = export.finish()
+            zip_bytes = zip_file.seek(0, os.SEEK_END)
+            zip_file.close()
+
+        with telemetry.stage("merge"):
+            agg_df = pd.DataFrame(export.merge_rows(),
+                                  columns=['avatar_id', 'level', 'title_id', 'user_id', 'user_name', 'orig_order'])
+            merge_top = top_competition_ranking(agg_df, k=MERGE_TOP_N)
+
+        with telemetry.stage("render"):
+            build_table_html(merge_top.head(RENDER_ROWS), _RENDER_COLUMNS)
+
+    telemetry.zip_bytes = zip_bytes
+    telemetry.rows = sum(len(month_records) for month_records in records.values())
+    return telemetry
+
+
+def run_benchmark(sizes=DEFAULT_SIZES, month_counts=DEFAULT_MONTHS, repeat=1, max_limit=DEFAULT_MAX_LIMIT,
+                  log=None, **kwargs):
+    """全シナリオを計測し、シナリオごとの結果（各段階は repeat 回の中央値）のリストを返す"""
+    server, base_url = start_stub(max_limit)
+    results = []
+    try:
+        for fans in sizes:
+            for n_months in month_counts:
+                months = month_labels(n_months)
+                room_id = f"bench{fans}x{n_months}"
+                server.RequestHandlerClass.rooms = {room_id: synthetic_room(fans, months)}
+                runs = [run_pipeline(base_url, room_id, months, **kwargs) for _ in range(max(repeat, 1))]
+                stages = {name: round(statistics.median(t.stages[name] for t in runs), 4) for name, _ in STAGES}
+                results.append({
+                    "scenario": f"{fans}x{n_months}",
+                    "fans": fans,
+                    "months": n_months,
+                    "rows": runs[0].rows,
+                    "requests": runs[0].summary()["requests"],
+                    "zip_mb": round(runs[0].zip_bytes / 1024 / 1024, 2),
+                    "stages": stages,
+                    "total": round(sum(stages.values()), 4),
+                })
+                if log is not None:
+                    log(f"{fans} 人 × {n_months} か月: {results[-1]['total']} 秒")
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+# ----- 結果の表示・保存 -----
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def to_report(results, args=None):
+    return {
+        "commit": _git_commit(),
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "settings": vars(args) if args is not None else {},
+        "results": results,
+    }
+
+
+def format_table(results, baseline=None):
+    """結果を表にする（baseline を渡すと合計の前回比と遅くなった段階を付ける）"""
+    base = {r["scenario"]: r for r in (baseline or {}).get("results", [])}
+    headers = ["シナリオ", "行数", "リクエスト"] + [label for _, label in STAGES] + ["合計(秒)", "ZIP(MB)"]
+    if baseline is not None:
+        headers += ["前回比", "遅化した段階"]
+    rows = []
+    for r in results:
+        row = [f"{r['fans']:,} 人 × {r['months']} か月", f"{r['rows']:,}", r["requests"]]
+        row += [f"{r['stages'][name]:.3f}" for name, _ in STAGES]
+        row += [f"{r['total']:.3f}", r["zip_mb"]]
+        if baseline is not None:
+            old = base.get(r["scenario"])
+            if old is None:
+                row += ["-", ""]
+            else:
+                row += [f"{r['total'] / old['total']:.2f}x" if old["total"] else "-",
+                        ", ".join(label for name, label in regressions(r, old))]
+        rows.append(row)
+    return tabulate(rows, headers=headers, tablefmt="github", disable_numparse=True)
+
+
+def regressions(result, old, ratio=REGRESSION_RATIO, min_sec=0.05):
+    """前回より ratio 倍以上遅くなった段階（min_sec 未満の差は計測誤差として無視する）"""
+    slow = []
+    for name, label in STAGES:
+        before = old["stages"].get(name)
+        after = result["stages"][name]
+        if before is not None and after - before >= min_sec and after > before * ratio:
+            slow.append((name, label))
+    return slow
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="スタブサーバーを使った取得・集計・ZIP作成のベンチマーク")
+    parser.add_argument("--sizes", nargs="+", type=int, default=list(DEFAULT_SIZES),
+                        help=f"1か月あたりのファン数（既定: {' '.join(map(str, DEFAULT_SIZES))}）")
+    parser.add_argument("--months", nargs="+", type=int, default=list(DEFAULT_MONTHS),
+                        help=f"月数（既定: {' '.join(map(str, DEFAULT_MONTHS))}）")
+    parser.add_argument("--repeat", type=int, default=1, help="シナリオごとの計測回数（中央値を採用、既定: 1）")
+    parser.add_argument("--workers", type=int, default=DEFAULT_MAX_WORKERS,
+                        help=f"同時リクエスト数（既定: {DEFAULT_MAX_WORKERS}）")
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE_PER_SEC,
+                        help=f"1秒あたりのリクエスト上限（既定: アプリと同じ {DEFAULT_RATE_PER_SEC}）")
+    parser.add_argument("--max-limit", type=int, default=DEFAULT_MAX_LIMIT,
+                        help=f"スタブが1ページで返す最大件数（既定: {DEFAULT_MAX_LIMIT}）")
+    parser.add_argument("--json", metavar="PATH", help="結果をJSONで保存する（--compare の比較元になる）")
+    parser.add_argument("--compare", metavar="PATH", help="比較元のJSON（前回の --json の出力）")
+    parser.add_argument("--out", metavar="PATH", help="結果の表をテキストで保存する")
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    results = run_benchmark(args.sizes, args.months, repeat=args.repeat, max_limit=args.max_limit,
+                            max_workers=args.workers, rate_per_sec=args.rate,
+                            log=lambda line: print(line, file=sys.stderr))
+    report = to_report(results, args)
+    table = format_table(results, baseline)
+    header = f"commit {report['commit'] or '-'} / Python {report['python']} / {report['created_at']}"
+    if baseline is not None:
+        header += f"（比較元: commit {baseline.get('commit') or '-'} / {baseline.get('created_at', '-')}）"
+    print(header)
+    print(table)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(header + "\n" + table + "\n")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if baseline is not None:
+        base = {r["scenario"]: r for r in baseline.get("results", [])}
+        if any(regressions(r, base[r["scenario"]]) for r in results if r["scenario"] in base):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
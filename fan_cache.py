@@ -0,0 +1,216 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime
+from itertools import islice
+
+# ----- 月別ファンデータのディスクキャッシュ -----
+# 月が締まった後に保存したデータは変化しないため永続保存し、それ以外（当月中に保存したもの）は短いTTLで扱う
+CACHE_PATH = os.environ.get("SR_FAN_CACHE_PATH", os.path.join(".fan_cache", "fan_cache.sqlite3"))
+CURRENT_MONTH_TTL_SEC = 15 * 60
+
+_init_lock = threading.Lock()
+_initialized_paths = set()
+
+
+def _connect(path=None):
+    path = path or CACHE_PATH
+    if path not in _initialized_paths:
+        with _init_lock:
+            if path not in _initialized_paths:
+                dirname = os.path.dirname(path)
+                if dirname:
+                    os.makedirs(dirname, exist_ok=True)
+                conn = sqlite3.connect(path, timeout=30)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS fan_months ("
+                    " room_id TEXT NOT NULL,"
+                    " ym TEXT NOT NULL,"
+                    " header_json TEXT,"
+                    " header_at REAL,"
+                    " users_blob BLOB,"
+                    " users_at REAL,"
+                    " PRIMARY KEY (room_id, ym))"
+                )
+                conn.commit()
+                conn.close()
+                _initialized_paths.add(path)
+    return sqlite3.connect(path, timeout=30)
+
+
+def current_ym(now=None):
+    return (now or datetime.now()).strftime("%Y%m")
+
+
+def is_closed_month(ym, now=None):
+    """当月より前の月（=データが確定している月）か"""
+    return str(ym) < current_ym(now)
+
+
+def month_end_ts(ym):
+    """ym の翌月1日 0:00（ローカル時刻）の time.time() 値（この時刻以降に取得したデータは確定している）"""
+    year, month = int(str(ym)[:4]), int(str(ym)[4:6])
+    return datetime(year + month // 12, month % 12 + 1, 1).timestamp()
+
+
+def is_fresh(ym, stored_at, now_ts=None):
+    """stored_at（time.time()）に保存した ym のデータがまだ使えるか
+
+    月が締まった後に保存したデータは常に有効。当月中に保存したデータは、
+    その月が締まった後も途中経過のままなので当月と同じ TTL で期限切れにする。
+    """
+    if stored_at is None:
+        return False
+    if stored_at >= month_end_ts(ym):
+        return True
+    return ((now_ts or time.time()) - stored_at) < CURRENT_MONTH_TTL_SEC
+
+
+def _pack_users(users, chunk_size=1000):
+    """ユーザー dict の並び（リスト・FanRecords など）を JSON 配列として圧縮する
+
+    全件の dict のリストや JSON 文字列は作らず、chunk_size 件ずつ書き進める。
+    """
+    compressor = zlib.compressobj()
+    parts = [compressor.compress(b"[")]
+    users = iter(users)
+    sep = b""
+    while True:
+        chunk = list(islice(users, chunk_size))
+        if not chunk:
+            break
+        body = json.dumps(chunk, ensure_ascii=False, separators=(",", ":"))[1:-1].encode("utf-8")
+        parts.append(compressor.compress(sep + body))
+        sep = b","
+    parts.append(compressor.compress(b"]"))
+    parts.append(compressor.flush())
+    return b"".join(parts)
+
+
+def _unpack_users(blob):
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+
+def load_header(room_id, ym, path=None, allow_stale=False):
+    """先頭ページのJSON（count, total_user_count 等）を返す。未保存・期限切れなら None
+
+    allow_stale=True なら期限切れでも保存済みの内容を返す（差分更新の比較用）。
+    """
+    conn = _connect(path)
+    try:
+        row = conn.execute(
+            "SELECT header_json, header_at FROM fan_months WHERE room_id = ? AND ym = ?",
+            (str(room_id), str(ym))
+        ).fetchone()
+    finally:
+        conn.close()
+    if row is None or row[0] is None or (not allow_stale and not is_fresh(ym, row[1])):
+        return None
+    return json.loads(row[0])
+
+
+def save_header(room_id, ym, header, path=None):
+    conn = _connect(path)
+    try:
+        conn.execute(
+            "INSERT INTO fan_months (room_id, ym, header_json, header_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(room_id, ym) DO UPDATE SET header_json = excluded.header_json, header_at = excluded.header_at",
+            (str(room_id), str(ym), json.dumps(header, ensure_ascii=False), time.time())
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def load_users(room_id, ym, path=None, with_stored_at=False):
+    """月の全ユーザー（オフセット順）を返す。未保存・期限切れなら None
+
+    with_stored_at=True なら (users, 保存時刻) を返す（未保存・期限切れなら (None, None)）。
+    """
+    conn = _connect(path)
+    try:
+        row = conn.execute(
+            "SELECT users_blob, users_at FROM fan_months WHERE room_id = ? AND ym = ?",
+            (str(room_id), str(ym))
+        ).fetchone()
+    finally:
+        conn.close()
+    if row is None or row[0] is None or not is_fresh(ym, row[1]):
+        return (None, None) if with_stored_at else None
+    users = _unpack_users(row[0])
+    return (users, row[1]) if with_stored_at else users
+
+
+def save_users(room_id, ym, users, path=None, stored_at=None):
+    """欠損なく取得できた月のみ保存すること（途中失敗の月を永続化しないため）
+
+    users: ユーザー dict の並び（リスト または fan_records.FanRecords）
+    stored_at: 保存時刻として記録する time.time() 値（省略時は現在時刻）。
+               月の締めをまたいで取得した場合に確定扱いにならないよう、取得開始時刻を渡す。
+    """
+    conn = _connect(path)
+    try:
+        conn.execute(
+            "INSERT INTO fan_months (room_id, ym, users_blob, users_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(room_id, ym) DO UPDATE SET users_blob = excluded.users_blob, users_at = excluded.users_at",
+            (str(room_id), str(ym), _pack_users(users), stored_at or time.time())
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def touch_users(room_id, ym, path=None):
+    """件数が変わっていないことを確認できた月の保存時刻を更新する（当月の TTL を延長）
+
+    締め前に保存した全ユーザーは、件数が同じでもレベル等が確定していないため、
+    月が締まった後は延長しない（確定扱いにせず取り直させる）。
+    戻り値: 延長できたか
+    """
+    now = time.time()
+    end = month_end_ts(ym)
+    conn = _connect(path)
+    try:
+        cur = conn.execute(
+            "UPDATE fan_months SET users_at = ? WHERE room_id = ? AND ym = ? AND users_blob IS NOT NULL"
+            " AND (? < ? OR users_at >= ?)",
+            (now, str(room_id), str(ym), now, end, end)
+        )
+        conn.commit()
+        return cur.rowcount > 0
+    finally:
+        conn.close()
+
+
+def drop_users(room_id, ym, path=None):
+    """先頭ページは残したまま、月の全ユーザーだけを破棄する"""
+    conn = _connect(path)
+    try:
+        conn.execute(
+            "UPDATE fan_months SET users_blob = NULL, users_at = NULL WHERE room_id = ? AND ym = ?",
+            (str(room_id), str(ym))
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def invalidate(room_id, months=None, path=None):
+    """指定ルーム（months 指定時はその月のみ）のキャッシュを削除し、削除件数を返す"""
+    conn = _connect(path)
+    try:
+        if months:
+            cur = conn.executemany(
+                "DELETE FROM fan_months WHERE room_id = ? AND ym = ?",
+                [(str(room_id), str(ym)) for ym in months]
+            )
+        else:
+            cur = conn.execute("DELETE FROM fan_months WHERE room_id = ?", (str(room_id),))
+        conn.commit()
+        return cur.rowcount
+    finally:
+        conn.close()
@@ -0,0 +1,89 @@
+# ----- 取得データの完全性チェック -----
+# 先頭ページの count と、実際に取得できたユニークな user_id 数を月ごとに突き合わせる
+COMPLETENESS_COLUMNS = ["年月", "件数(count)", "取得行数", "ユニークID数", "重複行数", "不足数", "欠損範囲", "状態"]
+
+STATUS_COMPLETE = "完全"
+STATUS_MISSING = "欠損あり"
+STATUS_MISMATCH = "件数不一致"
+STATUS_NO_HEADER = "取得失敗"
+
+
+def merge_ranges(ranges):
+    """[(offset, limit), ...] を重なり・隣接をまとめた [(start, end), ...]（end は含まない）にする"""
+    merged = []
+    for start, end in sorted((o, o + l) for o, l in ranges if l > 0):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(r) for r in merged]
+
+
+def format_ranges(ranges):
+    """[(start, end), ...] を「0-49, 200-249」形式（両端を含む）の文字列にする"""
+    return ", ".join(f"{start}-{end - 1}" for start, end in ranges)
+
+
+def _row_counts(users):
+    # fan_records.FanRecords とユーザー dict のリストのどちらも受け付ける
+    if hasattr(users, "unique_user_count"):
+        return len(users), users.unique_user_count()
+    return len(users), len({u.get("user_id") for u in users})
+
+
+def month_completeness(ym, count, users, missing=(), header_failed=False):
+    """1か月分の完全性を判定する
+
+    users: その月のユーザー（dict のリスト または FanRecords）
+    missing: 再取得しても取れなかったページの [(offset, limit), ...]
+    header_failed: 先頭ページを取得できなかった（count が分からず1件も取得していない）月なら True
+    取得漏れがなくても、取得中に順位が入れ替わると重複・不足が生じるため
+    ユニークな user_id 数で判定する。
+    """
+    count = int(count or 0)
+    rows, unique = _row_counts(users)
+    ranges = merge_ranges(missing)
+    if header_failed:
+        return {
+            "年月": ym,
+            "件数(count)": count,
+            "取得行数": rows,
+            "ユニークID数": unique,
+            "重複行数": rows - unique,
+            "不足数": 0,
+            "欠損範囲": "全件（先頭ページを取得できませんでした）",
+            "状態": STATUS_NO_HEADER,
+        }
+    if ranges:
+        status = STATUS_MISSING
+    elif unique != count:
+        status = STATUS_MISMATCH
+    else:
+        status = STATUS_COMPLETE
+    return {
+        "年月": ym,
+        "件数(count)": count,
+        "取得行数": rows,
+        "ユニークID数": unique,
+        "重複行数": rows - unique,
+        "不足数": max(count - unique, 0),
+        "欠損範囲": format_ranges(ranges),
+        "状態": status,
+    }
+
+
+def completeness_report(month_counts, month_users, missing, header_failed=()):
+    """月ごとの完全性レポート
+
+    month_counts: {ym: count} / month_users: {ym: users} / missing: {ym: [(offset, limit), ...]}
+    header_failed: 先頭ページを取得できなかった月
+    戻り値: COMPLETENESS_COLUMNS をキーに持つ dict のリスト（month_counts の順）
+    """
+    return [
+        month_completeness(ym, count, month_users.get(ym, []), missing.get(ym, ()), ym in header_failed)
+        for ym, count in month_counts.items()
+    ]
+
+
+def incomplete_months(report):
+    return [row["年月"] for row in report if row["状態"] != STATUS_COMPLETE]
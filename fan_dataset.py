@@ -0,0 +1,111 @@
+from fan_completeness import completeness_report
+from fan_fetcher import crawl_months, get_headers, sync_headers
+from fan_records import FanRecords, NameTable, records_frame
+
+
+class FanDataset:
+    """1ルーム分の取得結果の入れ物
+
+    月ごとの先頭ページ（total_user_count, fan_power, fan_name, count）と全ユーザーを持つ。
+    バックグラウンドジョブ・統計表示がそれぞれ作り、スレッド間では共有しない。
+    一度取得した月は共有キャッシュ（fan_shared）とディスクキャッシュ（fan_cache）から読むため、
+    同じ月を別の機能で開き直してもクロールは繰り返さない。
+    全ユーザーは型付きの FanRecords に詰め替えて持つ。
+    """
+
+    def __init__(self, room_id):
+        self.room_id = str(room_id)
+        self.headers = {}   # {ym: 先頭ページJSON}
+        self.users = {}     # {ym: FanRecords（オフセット順）}
+        self.names = NameTable()    # 全月で共有するユーザー名の文字列表
+        self.failed = {}    # {ym: [(offset, limit, 例外), ...]} 再取得しても取れなかったページ
+        self.header_failed = {}     # {ym: 例外} 先頭ページを取得できなかった月（次回の呼び出しで取り直す）
+
+    def ensure_headers(self, months, **kwargs):
+        """不足している月の先頭ページだけを取得する"""
+        missing = [ym for ym in months if ym not in self.headers]
+        if missing:
+            headers, errors = get_headers(self.room_id, missing, **kwargs)
+            self.headers.update(headers)
+            self._set_header_failed(missing, errors)
+        return {ym: self.headers[ym] for ym in months if ym in self.headers}
+
+    def _set_header_failed(self, months, errors):
+        for ym in months:
+            if ym in errors and ym not in self.headers:
+                self.header_failed[ym] = errors[ym]
+            else:
+                self.header_failed.pop(ym, None)
+
+    def sync(self, months, **kwargs):
+        """差分更新：先頭ページを取り直し、件数が変わった月（と新しい月）だけを未取得に戻す
+
+        戻り値: 再取得が必要な月のリスト
+        """
+        headers, errors, changed = sync_headers(self.room_id, months, **kwargs)
+        for ym, data in headers.items():
+            old = self.headers.get(ym)
+            self.headers[ym] = data
+            if ym in changed or (old is not None and old.get("count") != data.get("count")):
+                self.users.pop(ym, None)
+        # 取り直せなくても前回の先頭ページで代用できた月は失敗として扱わない
+        self._set_header_failed(months, errors)
+        return changed
+
+    def ensure_users(self, months, on_page=None, **kwargs):
+        """不足している月（前回失敗した月を含む）の全ユーザーを取得する
+
+        戻り値: {ym: FanRecords}
+        """
+        self.ensure_headers(months, stats=kwargs.get("stats"), telemetry=kwargs.get("telemetry"))
+        # 先頭ページが取れなかった月は件数が分からないため取得しない
+        # （件数0として空の月がキャッシュに保存され、締め済みの月では取り直せなくなるのを防ぐ）
+        missing = {ym: self.count(ym) for ym in months
+                   if ym in self.headers and (ym not in self.users or self.failed.get(ym))}
+        if on_page is not None:
+            # 取得済みの月も進捗表示が完了状態になるよう通知する（dict には戻さずそのまま渡す）
+            for ym in months:
+                if ym not in missing and ym in self.users:
+                    on_page(ym, 0, self.users[ym])
+        if missing:
+            # ページは届いた時点でこのデータセットの NameTable を使う FanRecords になる
+            users, failed = crawl_months(self.room_id, missing, on_page=on_page, names=self.names, **kwargs)
+            self.users.update(users)
+            for ym in missing:
+                self.failed[ym] = [(offset, limit, e) for (m, offset, limit, e) in failed if m == ym]
+        return {ym: self.users.get(ym) or FanRecords(self.names) for ym in months}
+
+    def frame(self, months):
+        """取得済みの月を1つの DataFrame（user_id, level, title_id, avatar_id, user_name, ym）にする"""
+        return records_frame({ym: self.users[ym] for ym in sorted(months) if ym in self.users})
+
+    def count(self, ym):
+        return self.headers.get(ym, {}).get("count", 0)
+
+    def summary(self, ym):
+        data = self.headers.get(ym)
+        if data is None:
+            return None
+        return {
+            "年月": ym,
+            "ファン数": data.get("total_user_count", 0),
+            "ファンパワー": data.get("fan_power", 0),
+            "ファン名称": data.get("fan_name", "-")
+        }
+
+    def failed_months(self, months):
+        """取得できなかったページがある月と、先頭ページを取得できなかった月"""
+        return [ym for ym in months if self.failed.get(ym) or ym in self.header_failed]
+
+    def header_failed_months(self, months):
+        return [ym for ym in months if ym in self.header_failed]
+
+    def completeness(self, months):
+        """月ごとに count と取得できたユニーク user_id 数を突き合わせたレポート"""
+        return completeness_report(
+            {ym: self.count(ym) for ym in months},
+            self.users,
+            {ym: [(offset, limit) for offset, limit, _ in self.failed.get(ym, [])] for ym in months},
+            self.header_failed
+        )
+
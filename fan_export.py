@@ -0,0 +1,268 @@
+import csv
+import io
+import os
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZIP_BZIP2, ZIP_DEFLATED, ZIP_LZMA, ZIP_STORED, ZipFile
+
+from fan_completeness import COMPLETENESS_COLUMNS
+
+# ----- ZIP（月別CSV + マージCSV + 完全性レポート）出力 -----
+MONTH_COLUMNS = ['avatar_id', 'level', 'title_id', 'user_id', 'user_name']
+MERGE_COLUMNS = ['avatar_id', 'level', 'title_id', 'user_id', 'user_name']
+
+# 圧縮形式: {名前: (zipfile の圧縮方式, 既定の圧縮レベル)}
+# OS標準の展開機能（Windows のエクスプローラー等）で開けるのは stored と deflate のみ。
+COMPRESSION_CODECS = {
+    "deflate": (ZIP_DEFLATED, 6),
+    "bzip2": (ZIP_BZIP2, 9),
+    "lzma": (ZIP_LZMA, None),      # lzma は圧縮レベルを指定できない
+    "stored": (ZIP_STORED, None),
+}
+if hasattr(zipfile, "ZIP_ZSTANDARD"):  # Python 3.14 以降のみ
+    COMPRESSION_CODECS["zstd"] = (zipfile.ZIP_ZSTANDARD, 3)
+DEFAULT_COMPRESSION = "deflate"
+
+# orig_order は (選択順の月インデックス, 月内の位置) を1つの整数にまとめたもの。
+# 大小関係は従来の通し番号と同じなので、月の取得完了順に依存せず集計できる。
+_ORDER_SHIFT = 32
+
+
+def month_csv_name(room_id, month):
+    return f"active_fans_{room_id}_{month}.csv"
+
+
+def merge_csv_name(room_id):
+    return f"active_fans_{room_id}_merge.csv"
+
+
+def completeness_csv_name(room_id):
+    return f"active_fans_{room_id}_completeness.csv"
+
+
+def _csv_writer(fp):
+    # pandas の to_csv と同じ出力（QUOTE_MINIMAL / 改行 os.linesep）にする
+    return csv.writer(fp, lineterminator=os.linesep)
+
+
+class _MonthSpool:
+    """1か月分のCSVを一時ファイルへ追記する（ページの到着順が前後しても offset 順で書く）"""
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile(mode="w+", encoding="utf-8", newline="")
+        self.file.write("\ufeff")
+        self.writer = _csv_writer(self.file)
+        self.writer.writerow(MONTH_COLUMNS)
+        self.next_offset = 0
+        self.pending = {}   # 先に届いた後続ページ {offset: users}
+        self.rows = 0
+
+    def add(self, offset, users):
+        self.pending[offset] = users
+        # ページサイズは可変なので、書いた件数だけ次のオフセットを進める
+        while self.next_offset in self.pending:
+            users = self.pending.pop(self.next_offset)
+            self._write(users)
+            self.next_offset += len(users)
+
+    def flush(self):
+        # 欠損ページがあっても残りを offset 順に書き出す
+        for offset in sorted(self.pending):
+            self._write(self.pending.pop(offset))
+
+    def _write(self, users):
+        for u in users:
+            self.writer.writerow([u.get(c) for c in MONTH_COLUMNS])
+        self.rows += len(users)
+
+
+def _write_spool(zip_file, name, spool):
+    """月別CSVの一時ファイルを UTF-8 にして、ZipFile.open() の書き込みストリームで圧縮しながら追加する
+
+    書き込み用のスレッドで実行する。zipfile は同時に1メンバーしか書けないため、呼び出しは直列にする。
+    """
+    try:
+        # 2GiB を超える月は ZIP64 のヘッダーが必要になる（UTF-8 のバイト数で判定する）
+        size = spool.file.seek(0, os.SEEK_END)
+        spool.file.seek(0)
+        reader = _EncodedReader(spool.file)
+        with zip_file.open(name, "w", force_zip64=size > zipfile.ZIP64_LIMIT) as dest:
+            while True:
+                data = reader.read()
+                if not data:
+                    break
+                dest.write(data)
+    finally:
+        spool.file.close()
+
+
+class StreamingZipExport:
+    """ページ単位でCSVを書き進め、マージ集計も逐次更新するZIP出力
+
+    ピークメモリは「未整列ページ数 × ページサイズ」と「ユニークユーザー数」で決まり、
+    全件の行データは保持しない。アーカイブ自体も一時ファイルへスプールする。
+    取得が終わった月のCSVは書き込み用のスレッドで圧縮し、他の月の取得と並行して進める。
+    アーカイブ内の並び順は月の選択順で固定する（前の月が終わるまで後の月は書き始めない）。
+
+    使い方:
+        export = StreamingZipExport(room_id, months)
+        export.add_page(month, offset, users)   # fetch_months の on_page から呼ぶ
+        fileobj = export.finish()               # 先頭にシーク済みのZIP
+    """
+
+    def __init__(self, room_id, months, fileobj=None, compression=DEFAULT_COMPRESSION, compresslevel=None):
+        if compression not in COMPRESSION_CODECS:
+            raise ValueError(f"未対応の圧縮形式です: {compression}（{', '.join(COMPRESSION_CODECS)}）")
+        self.room_id = room_id
+        self.months = list(months)
+        self.month_index = {m: i for i, m in enumerate(self.months)}
+        self.fileobj = fileobj if fileobj is not None else tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+        self.compress_type, default_level = COMPRESSION_CODECS[compression]
+        self.compresslevel = compresslevel if compresslevel is not None else default_level
+        self.zip_file = ZipFile(self.fileobj, "w", compression=self.compress_type, compresslevel=self.compresslevel)
+        # ZipFile への書き込みはこのスレッドだけが行う（zlib / bz2 / lzma は圧縮中に GIL を解放する）
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fan-zip")
+        self._writes = []   # 書き込み中・書き込み待ちの Future
+        self._closed = {}   # {month: 書き出し待ちの _MonthSpool（空の月は None）}
+        self._next = 0      # 次にアーカイブへ追加する月の選択順インデックス
+        self.spools = {}
+        self.expected = {}
+        self.month_rows = {}
+        self.agg = {}       # {user_id: [level合計, avatar_id, user_name, orig_order]}
+
+    def expect(self, month, count):
+        """月の件数を登録しておくと、件数に達した時点でZIPへ書き出す"""
+        self.expected[month] = count
+        if not count and month not in self.spools:
+            # 件数0の月はページが届かないので、後の月の書き出しを待たせない
+            self._closed.setdefault(month, None)
+            self._submit_ready()
+
+    def add_page(self, month, offset, users):
+        if month not in self.spools:
+            self.spools[month] = _MonthSpool()
+        spool = self.spools[month]
+        base = self.month_index[month] << _ORDER_SHIFT
+        for pos, u in enumerate(users, start=offset):
+            self._merge(u, base + pos)
+        spool.add(offset, users)
+        if month in self.expected and spool.rows >= self.expected[month] and not spool.pending:
+            self.close_month(month)
+
+    def _merge(self, u, orig_order):
+        uid = u.get('user_id')
+        rec = self.agg.get(uid)
+        if rec is None:
+            self.agg[uid] = [u.get('level', 0) or 0, u.get('avatar_id'), u.get('user_name'), orig_order]
+            return
+        rec[0] += u.get('level', 0) or 0
+        # 従来どおり「最後に出現した行」のアバター・名前・順序を採用する
+        if orig_order > rec[3]:
+            rec[1], rec[2], rec[3] = u.get('avatar_id'), u.get('user_name'), orig_order
+
+    def close_month(self, month):
+        spool = self.spools.pop(month, None)
+        if spool is None:
+            return
+        spool.flush()
+        self.month_rows[month] = spool.rows
+        if spool.rows > 0:
+            self._closed[month] = spool
+        else:
+            spool.file.close()
+            self._closed[month] = None
+        self._submit_ready()
+
+    def _submit_ready(self):
+        """選択順で先頭から取得の終わっている月を書き込み用のスレッドへ渡す"""
+        while self._next < len(self.months) and self.months[self._next] in self._closed:
+            month = self.months[self._next]
+            spool = self._closed.pop(month)
+            self._next += 1
+            if spool is not None:
+                self._writes.append(self._writer.submit(
+                    _write_spool, self.zip_file, month_csv_name(self.room_id, month), spool))
+
+    def _write_members(self):
+        """残りの月別CSVを書き込み用のスレッドへ渡し、すべて書き終わるまで待つ"""
+        for month in list(self.spools):
+            self.close_month(month)
+        for month in self.months[self._next:]:
+            self._closed.setdefault(month, None)
+        self._submit_ready()
+        while self._writes:
+            self._writes.pop(0).result()
+
+    def add_tree(self, root, prefix):
+        """root 以下のファイルを prefix/ 配下に格納する（Parquet 等の圧縮済みファイルは無圧縮で入れる）
+
+        取得の終わっていない月があっても、先に月別CSVをすべて書き終えてから追加する。
+        """
+        self._write_members()
+        for dirpath, _, filenames in os.walk(root):
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                arcname = "/".join([prefix] + os.path.relpath(path, root).split(os.sep))
+                self.zip_file.write(path, arcname, compress_type=ZIP_STORED)
+
+    def _write_csv(self, name, columns, rows):
+        with self.zip_file.open(name, "w") as dest:
+            text = io.TextIOWrapper(dest, encoding="utf-8-sig", newline="")
+            writer = _csv_writer(text)
+            writer.writerow(columns)
+            writer.writerows(rows)
+            text.flush()
+            text.detach()
+
+    def merge_rows(self):
+        """マージ結果を (avatar_id, level, title_id, user_id, user_name, orig_order) のリストで返す
+
+        並び順はレベル合計の降順、同値は orig_order の昇順。
+        """
+        rows = [
+            (rec[1], rec[0], int(rec[0] // 5), uid, rec[2], rec[3])
+            for uid, rec in self.agg.items()
+        ]
+        rows.sort(key=lambda r: (-r[1], r[5]))
+        return rows
+
+    def finish(self, with_merge=True, completeness=None):
+        """残りの月別CSVとマージCSV（completeness 指定時は完全性レポートCSVも）を書いて閉じる
+
+        completeness: fan_completeness.completeness_report() の戻り値
+        """
+        try:
+            self._write_members()
+        finally:
+            self._writer.shutdown(wait=True, cancel_futures=True)
+        if with_merge and self.agg:
+            self._write_csv(merge_csv_name(self.room_id), MERGE_COLUMNS, (r[:5] for r in self.merge_rows()))
+        if completeness:
+            self._write_csv(completeness_csv_name(self.room_id), COMPLETENESS_COLUMNS,
+                            ([row[c] for c in COMPLETENESS_COLUMNS] for row in completeness))
+        self.zip_file.close()
+        self.fileobj.seek(0)
+        return self.fileobj
+
+
+class _EncodedReader:
+    """テキスト一時ファイルを UTF-8 バイト列として読み出すための薄いラッパー"""
+
+    def __init__(self, text_file, chunk_chars=64 * 1024):
+        self.text_file = text_file
+        self.chunk_chars = chunk_chars
+
+    def read(self, size=-1):
+        return self.text_file.read(self.chunk_chars).encode("utf-8")
+
+
+def write_zip(room_id, month_users, path):
+    """取得済みの {month: users} からZIPを書き出す（ヘッドレス利用向け）"""
+    with open(path, "wb") as fp:
+        export = StreamingZipExport(room_id, list(month_users), fileobj=fp)
+        for month, users in month_users.items():
+            export.add_page(month, 0, users)
+            export.close_month(month)
+        export.finish()
+    return path
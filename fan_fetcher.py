@@ -0,0 +1,329 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import fan_cache
+import showroom_client
+from fan_completeness import STATUS_COMPLETE, month_completeness
+from fan_records import FanRecords, NameTable
+from fan_shared import get_shared_cache
+from fan_throttle import get_controller
+
+# ----- SHOWROOM アクティブファンAPI -----
+ACTIVE_FAN_URL = "https://www.showroom-live.com/api/active_fan/users"
+
+# 同時接続数の上限と1秒あたりの最大リクエスト数（従来の sleep(0.05) 相当を上限とする）。
+# 実際の同時数・間隔・ページサイズは fan_throttle の制御器が応答状況から調整する。
+DEFAULT_MAX_WORKERS = 6
+DEFAULT_RATE_PER_SEC = 20.0
+# 一巡目で取得できなかったページを取り直す回数
+DEFAULT_REFETCH_ROUNDS = 1
+
+
+def fetch_page(room_id, ym, offset=None, limit=None, base_url=ACTIVE_FAN_URL, stats=None):
+    """1ページ分を取得してJSONを返す（offset/limit省略時は先頭ページ）"""
+    params = {"room_id": room_id, "ym": ym}
+    if offset is not None:
+        params["offset"] = offset
+    if limit is not None:
+        params["limit"] = limit
+    return showroom_client.get_json(base_url, params=params, stats=stats)
+
+
+def page_offsets(count, per_page):
+    """count 件を per_page 件ずつ取得するためのオフセット一覧"""
+    return list(range(0, max(int(count or 0), 0), per_page))
+
+
+def _controlled_fetch(controller, room_id, ym, offset, limit, base_url, stats, max_workers, rate_per_sec,
+                      telemetry=None):
+    """制御器の送信枠を取ってから1ページ取得し、結果（レイテンシ・混雑の有無）を制御器へ返す
+
+    混雑として同時数を下げるのは、再試行が発生したか、429・5xx・タイムアウトで失敗した場合だけ
+    （404 や JSON 解析エラーは混雑ではないため同時数を変えない）。
+    telemetry（fan_telemetry.Telemetry）を渡すと1リクエストごとの計測値を記録する。
+    """
+    min_delay = 1.0 / rate_per_sec if rate_per_sec and rate_per_sec > 0 else 0.0
+    queued = time.monotonic()
+    controller.acquire(max_concurrency=max_workers, min_delay=min_delay)
+    req_stats = showroom_client.new_stats()
+    started = time.monotonic()
+    throttled = False
+    data, error = None, ""
+    try:
+        data = fetch_page(room_id, ym, offset=offset, limit=limit, base_url=base_url, stats=req_stats)
+        throttled = req_stats["retries"] > 0
+        return data
+    except Exception as e:
+        error = repr(e)
+        throttled = req_stats["retries"] > 0 or showroom_client.is_throttle_error(e)
+        raise
+    finally:
+        latency = time.monotonic() - started
+        controller.release(latency, throttled)
+        showroom_client.merge_stats(stats, req_stats)
+        if telemetry is not None:
+            telemetry.record_request(
+                room_id=room_id, ym=ym, offset=offset, limit=limit,
+                wait_sec=round(started - queued, 4), latency_sec=round(latency, 4),
+                parse_sec=round(req_stats["parse_sec"], 4), bytes=req_stats["bytes"],
+                retries=req_stats["retries"],
+                users=len(data.get("users") or []) if data is not None else None, error=error
+            )
+
+
+def fetch_headers(room_id, months, max_workers=DEFAULT_MAX_WORKERS,
+                  rate_per_sec=DEFAULT_RATE_PER_SEC, base_url=ACTIVE_FAN_URL, stats=None, controller=None,
+                  telemetry=None):
+    """各月の先頭ページ（count, total_user_count 等を含む）を並列取得する
+
+    戻り値: ({ym: data}, {ym: 例外})
+    """
+    controller = controller or get_controller()
+    headers, errors = {}, {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(_controlled_fetch, controller, room_id, ym, None, None,
+                        base_url, stats, max_workers, rate_per_sec, telemetry): ym
+            for ym in months
+        }
+        for fut in futures:
+            ym = futures[fut]
+            try:
+                headers[ym] = fut.result()
+            except Exception as e:
+                errors[ym] = e
+    controller.save()
+    return headers, errors
+
+
+def fetch_months(room_id, month_counts, per_page=None, max_workers=DEFAULT_MAX_WORKERS,
+                 rate_per_sec=DEFAULT_RATE_PER_SEC, on_page=None, base_url=ACTIVE_FAN_URL, stats=None,
+                 controller=None, telemetry=None, refetch_rounds=DEFAULT_REFETCH_ROUNDS, names=None):
+    """複数月・複数オフセットのページを同時に取得する
+
+    month_counts: {ym: count}（先頭ページで得た count）
+    per_page: 省略時は制御器が学習したページサイズ（未学習なら件数の多い月で計測する）
+    on_page: ページ取得ごとに呼ばれるコールバック on_page(ym, offset, records)。
+             records はそのページの FanRecords（件数は len(records)、行は for で1件ずつ dict になる）。
+             呼び出し元スレッドで実行されるため st.progress 等を直接更新してよい。
+    stats: showroom_client.new_stats() で作ったカウンタ（再試行回数等の集計用）
+    telemetry: fan_telemetry.Telemetry（リクエストごとの計測値と飛ばしたページを記録する）
+    names: ユーザー名を登録する NameTable（省略時は新しく作る）
+
+    届いたページはその場で FanRecords に詰め替え、APIの dict のリストは月単位で持たない。
+    要求より少ない件数が返ったページは、残りの範囲を追加で取得する。
+    最後のページ以外が空で返った場合は、例外と同じく取得できなかったページとして扱う。
+    全ページを一巡した後、取得できなかった範囲だけを refetch_rounds 回まで並列に取り直す
+    （集計の前に欠損を埋めるため。取り直せたページも on_page に渡す）。
+
+    戻り値: ({ym: FanRecords（オフセット順）}, [(ym, offset, limit, 例外), ...] 最終的に取得できなかったページ)
+    """
+    controller = controller or get_controller()
+    names = names if names is not None else NameTable()
+    largest = None
+    probed = {}     # {limit: users} ページサイズの計測で取得した largest の先頭ページ
+    if per_page is None:
+        largest = max(month_counts, key=lambda ym: month_counts[ym] or 0, default=None)
+        if largest is not None and controller.needs_page_size_probe():
+            def _probe(limit):
+                users = _controlled_fetch(controller, room_id, largest, 0, limit, base_url, stats,
+                                          max_workers, rate_per_sec, telemetry).get("users", []) or []
+                probed[limit] = users
+                return users
+
+            controller.probe_page_size(_probe, month_counts[largest] or 0)
+        per_page = controller.page_size
+
+    pages = {ym: {} for ym in month_counts}
+    # 採用したページサイズで取得済みの先頭ページは、そのまま1ページ目として使う
+    first_page = probed.get(per_page)
+    if first_page is not None and len(first_page) == per_page:
+        records = pages[largest][0] = FanRecords.from_users(first_page, names)
+        if on_page is not None:
+            on_page(largest, 0, records)
+    probed.clear()
+
+    def _task(ym, offset, limit):
+        data = _controlled_fetch(controller, room_id, ym, offset, limit, base_url, stats,
+                                 max_workers, rate_per_sec, telemetry)
+        return data.get("users", []) or []
+
+    def _run(pool, tasks):
+        """[(ym, offset, limit), ...] を並列に取得し、失敗したページを返す"""
+        futures = {pool.submit(_task, *t): t for t in tasks}
+        errors = []
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                ym, offset, limit = futures.pop(fut)
+                try:
+                    users = fut.result()
+                except Exception as e:
+                    errors.append((ym, offset, limit, e))
+                    continue
+                is_last_page = offset + limit >= (month_counts[ym] or 0)
+                if not users and not is_last_page:
+                    # 途中のページが空で返った：欠損として取り直し、取れなければ欠損範囲に載せる
+                    errors.append((ym, offset, limit, ValueError(f"空のページが返されました（offset={offset}）")))
+                    continue
+                records = pages[ym][offset] = FanRecords.from_users(users, names)
+                if 0 < len(users) < limit and not is_last_page:
+                    # 受け付けられる件数が想定より少ない：残りを取りに行き、以降のページサイズも下げる
+                    controller.report_short_page(len(users))
+                    rest = (ym, offset + len(users), limit - len(users))
+                    nf = pool.submit(_task, *rest)
+                    futures[nf] = rest
+                    pending.add(nf)
+                if on_page is not None:
+                    on_page(ym, offset, records)
+        return errors
+
+    tasks = [
+        (ym, offset, min(per_page, count - offset))
+        for ym, count in month_counts.items()
+        for offset in page_offsets(count, per_page)
+        if offset not in pages[ym]
+    ]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        failed = _run(pool, tasks)
+        for _ in range(refetch_rounds):
+            if not failed:
+                break
+            failed = _run(pool, [f[:3] for f in failed])
+
+    if telemetry is not None:
+        for ym, offset, _, e in failed:
+            telemetry.record_skipped(room_id, ym, offset, e)
+    controller.save()
+    results = {}
+    for ym, by_offset in pages.items():
+        records = results[ym] = FanRecords(names)
+        for offset in sorted(by_offset):
+            records.extend_records(by_offset.pop(offset))
+    failed.sort(key=lambda x: (x[0], x[1]))
+    return results, failed
+
+
+def get_headers(room_id, months, use_cache=True, **kwargs):
+    """キャッシュを優先して各月の先頭ページを返す（不足分のみ API から取得）
+
+    戻り値: ({ym: data}, {ym: 例外})
+    """
+    headers = {}
+    if use_cache:
+        for ym in months:
+            cached = fan_cache.load_header(room_id, ym)
+            if cached is not None:
+                headers[ym] = cached
+    missing = [ym for ym in months if ym not in headers]
+    errors = {}
+    if missing:
+        fetched, errors = fetch_headers(room_id, missing, **kwargs)
+        for ym, data in fetched.items():
+            fan_cache.save_header(room_id, ym, data)
+        headers.update(fetched)
+    return headers, errors
+
+
+def crawl_months(room_id, month_counts, use_cache=True, on_page=None, names=None, **kwargs):
+    """キャッシュを優先して各月の全ユーザーを返す（不足月のみクロールする）
+
+    共有メモリキャッシュ（fan_shared）→ ディスクキャッシュの順に探し、読めた月は
+    on_page(ym, 0, records) を1回だけ呼ぶ。同じ月を別のセッションがクロール中なら
+    二重に取得せず、その完了を待って結果を受け取る（相手が失敗した月は自分で取り直す）。
+    完全性チェックで「完全」（取得失敗ページがなく、ユニーク user_id 数が count と一致）の月だけを
+    キャッシュへ保存する（件数の合わない締め済みの月を固定しないため）。
+    month_counts には先頭ページを取得できた月だけを渡すこと（count が None の月は取得しない）。
+    names: ユーザー名を登録する NameTable（省略時は新しく作る。戻り値の FanRecords はすべてこれを共有する）
+
+    戻り値: ({ym: FanRecords}, [(ym, offset, limit, 例外), ...])
+    """
+    shared = get_shared_cache()
+    names = names if names is not None else NameTable()
+    results = {}
+    month_counts = {ym: count for ym, count in month_counts.items() if count is not None}
+
+    def _deliver(ym, records):
+        results[ym] = records
+        if on_page is not None:
+            on_page(ym, 0, records)
+
+    if use_cache:
+        for ym, count in month_counts.items():
+            records = shared.load(room_id, ym, count, names)
+            if records is None:
+                users, stored_at = fan_cache.load_users(room_id, ym, with_stored_at=True)
+                records = FanRecords.from_users(users, names) if users is not None else None
+                # ディスク側の保存時刻を引き継ぎ、締め前に取得した月は共有キャッシュでも TTL で切れるようにする
+                if records is not None:
+                    shared.store(room_id, ym, count, records, stored_at)
+            if records is not None:
+                _deliver(ym, records)
+
+    missing = {ym: c for ym, c in month_counts.items() if ym not in results}
+    failed = []
+    while missing:
+        mine, waiting = shared.claim(room_id, missing)
+        mine = {ym: missing[ym] for ym in mine}
+        try:
+            if mine:
+                # 取得中に月が締まっても確定扱いにしないよう、保存時刻は取得開始時刻にする
+                started_at = time.time()
+                fetched, month_failed = fetch_months(room_id, mine, on_page=on_page, names=names, **kwargs)
+                failed_months = set(f[0] for f in month_failed)
+                for ym, records in fetched.items():
+                    if ym not in failed_months and month_completeness(ym, mine[ym], records)["状態"] == STATUS_COMPLETE:
+                        fan_cache.save_users(room_id, ym, records, stored_at=started_at)
+                        shared.store(room_id, ym, mine[ym], records, started_at)
+                results.update(fetched)
+                failed.extend(month_failed)
+        finally:
+            shared.release(room_id, mine)
+
+        missing = {}
+        for ym, event in waiting.items():
+            event.wait()
+            records = shared.load(room_id, ym, month_counts[ym], names)
+            if records is None:
+                missing[ym] = month_counts[ym]
+            else:
+                _deliver(ym, records)
+    failed.sort(key=lambda x: (x[0], x[1]))
+    return results, failed
+
+
+def _same_counts(old, new):
+    return (old is not None
+            and old.get("count") == new.get("count")
+            and old.get("total_user_count") == new.get("total_user_count"))
+
+
+def sync_headers(room_id, months, **kwargs):
+    """差分更新用：各月の先頭ページを1回ずつ取り直し、保存済みの件数と比較する
+
+    count / total_user_count が前回と同じで全ユーザーが保存済みの月はそのまま使い
+    （当月も TTL を延長）、新しい月・件数が変わった月・締め前に保存したまま月が締まった月は
+    保存済みユーザーを破棄する。
+    以降の crawl_months は破棄された月だけをクロールする。
+
+    戻り値: ({ym: data}, {ym: 例外}, 再取得が必要な月のリスト)
+    """
+    fetched, errors = fetch_headers(room_id, months, **kwargs)
+    headers, changed = {}, []
+    for ym in months:
+        old = fan_cache.load_header(room_id, ym, allow_stale=True)
+        if ym not in fetched:
+            # 先頭ページが取れなかった月は前回の内容で代用する
+            if old is not None:
+                headers[ym] = old
+            continue
+        data = fetched[ym]
+        headers[ym] = data
+        fan_cache.save_header(room_id, ym, data)
+        if not (_same_counts(old, data) and fan_cache.touch_users(room_id, ym)):
+            fan_cache.drop_users(room_id, ym)
+            get_shared_cache().invalidate(room_id, [ym])
+            changed.append(ym)
+    return headers, errors, changed
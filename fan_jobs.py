@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# ----- バックグラウンドジョブ（スクリプトの再実行・再接続をまたいで処理を続ける） -----
+DEFAULT_WORKERS = int(os.environ.get("SR_FAN_JOB_WORKERS", "4"))
+JOB_RETENTION_SEC = 30 * 60      # 完了したジョブ（結果を含む）を保持する時間
+MAX_FINISHED_JOBS = 20
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+STATUS_LABELS = {QUEUED: "待機中", RUNNING: "実行中", DONE: "完了", FAILED: "失敗"}
+
+
+class Job:
+    """1件のバックグラウンド処理
+
+    ジョブ関数は fn(job, **params) の形で呼ばれ、job.update(...) で進捗を書き込む。
+    戻り値が job.result に入る。進捗はワーカーが書き、画面側が読むためロックで保護する。
+    """
+
+    def __init__(self, kind, label, params):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.label = label
+        self.params = params
+        self.status = QUEUED
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self._progress = {}
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    def update(self, **progress):
+        with self._lock:
+            self._progress.update(progress)
+
+    def progress(self):
+        with self._lock:
+            return dict(self._progress)
+
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+
+class JobManager:
+    """ワーカープールでジョブを実行し、ジョブIDで参照できるようにする"""
+
+    def __init__(self, max_workers=DEFAULT_WORKERS):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fan-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind, label, fn, **params):
+        job = Job(kind, label, params)
+        with self._lock:
+            self._purge()
+            self._jobs[job.id] = job
+        self._pool.submit(self._run, job, fn)
+        return job
+
+    def _run(self, job, fn):
+        job.started_at = time.time()
+        job.status = RUNNING
+        try:
+            result = fn(job, **job.params)
+        except Exception as e:
+            job.error = f"{e}"
+            job.update(traceback=traceback.format_exc())
+            status = FAILED
+        else:
+            job.result = result
+            status = DONE
+        # 他のスレッドが finished を見た時点で finished_at・結果がそろっているよう、状態は最後に変える
+        job.finished_at = time.time()
+        job.status = status
+
+    def get(self, job_id):
+        if not job_id:
+            return None
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self, job_ids):
+        with self._lock:
+            return [self._jobs[i] for i in job_ids if i in self._jobs]
+
+    def _purge(self):
+        now = time.time()
+        finished = sorted((j for j in self._jobs.values() if j.finished and j.finished_at is not None),
+                          key=lambda j: j.finished_at)
+        for i, job in enumerate(finished):
+            if now - job.finished_at > JOB_RETENTION_SEC or i < len(finished) - MAX_FINISHED_JOBS:
+                del self._jobs[job.id]
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_job_manager():
+    """プロセス内で共有するジョブ管理（全セッション共通）"""
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = JobManager()
+    return _manager
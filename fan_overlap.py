@@ -0,0 +1,152 @@
+import numpy as np
+import pandas as pd
+
+from fan_analysis import build_level_matrix
+
+# ----- 複数ルームのファン重複分析 -----
+# 全ルームの user_id を昇順に並べた共通の番号（列）に割り当て、ルームごとに
+# 「その番号のユーザーがファンか」を1ビットで持つ。2ルーム間の共通人数はビット列の AND の
+# 立っているビット数なので、20ルーム × 1万人でも数ミリ秒で全組み合わせを数えられる。
+SHARED_COLUMNS = ["順位", "user_id", "ユーザー名", "共通ルーム数", "レベル合計値"]
+
+
+def _popcount(bits):
+    """uint8 配列の行ごとの立っているビット数"""
+    if hasattr(np, "bitwise_count"):  # numpy 2.0 以降
+        return np.bitwise_count(bits).sum(axis=-1, dtype=np.int64)
+    return np.unpackbits(bits, axis=-1).sum(axis=-1, dtype=np.int64)
+
+
+def parse_room_ids(text):
+    """カンマ・空白・改行区切りのルームIDを重複を除いて入力順に返す"""
+    for sep in (",", "、", "\n", "\t", "　"):
+        text = text.replace(sep, " ")
+    return list(dict.fromkeys(t for t in text.split(" ") if t))
+
+
+class RoomFanSet:
+    """1ルーム分（選択月の合算）のファン: 昇順の user_id と、同じ並びのレベル合計・名前・アバター"""
+
+    def __init__(self, room_id, user_ids, level_totals, names, avatar_ids):
+        self.room_id = str(room_id)
+        self.user_ids = user_ids
+        self.level_totals = level_totals
+        self.names = names
+        self.avatar_ids = avatar_ids
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    @classmethod
+    def from_frame(cls, room_id, frame):
+        """FanDataset.frame() の戻り値から作る（詳細分析と同じレベル行列を経由する）"""
+        if not len(frame):
+            empty = np.array([], dtype=np.int64)
+            return cls(room_id, empty, empty, np.array([], dtype=object), np.array([], dtype=object))
+        matrix = build_level_matrix(frame)
+        return cls(room_id, matrix.user_ids, matrix.levels.sum(axis=1, dtype=np.int64),
+                   matrix.last_names, matrix.avatar_ids)
+
+
+class FanOverlap:
+    """複数ルームのファン集合の重複
+
+    user_ids: 全ルームのファンの和集合（int64・昇順）
+    bitmaps: uint8[n_rooms, ceil(n_users / 8)] ルームごとの所属ビット列
+    levels: int64[n_rooms, n_users] ルームごとのレベル合計（ファンでなければ0）
+    """
+
+    def __init__(self, fan_sets):
+        self.rooms = [s.room_id for s in fan_sets]
+        self.sizes = np.array([len(s) for s in fan_sets], dtype=np.int64)
+        parts = [s.user_ids for s in fan_sets]
+        self.user_ids = np.unique(np.concatenate(parts)) if parts else np.array([], dtype=np.int64)
+        n_users = len(self.user_ids)
+
+        member = np.zeros((len(fan_sets), n_users), dtype=bool)
+        self.levels = np.zeros((len(fan_sets), n_users), dtype=np.int64)
+        self.names = np.full(n_users, None, dtype=object)
+        self.avatar_ids = np.full(n_users, None, dtype=object)
+        for i, s in enumerate(fan_sets):
+            pos = np.searchsorted(self.user_ids, s.user_ids)
+            member[i, pos] = True
+            self.levels[i, pos] = s.level_totals
+            # 名前・アバターは後に指定したルームの値で上書きする
+            self.names[pos] = s.names
+            self.avatar_ids[pos] = s.avatar_ids
+        self.bitmaps = np.packbits(member, axis=1)
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def _index(self, rooms):
+        if rooms is None:
+            return list(range(len(self.rooms)))
+        return [self.rooms.index(str(r)) for r in rooms]
+
+    def membership(self, rooms=None):
+        """bool[n_rooms, n_users] の所属表（rooms を指定するとその行だけ）"""
+        return np.unpackbits(self.bitmaps[self._index(rooms)], axis=1, count=len(self.user_ids)).astype(bool)
+
+    def pairwise_counts(self):
+        """2ルーム間の共通ファン数の表（対角成分は各ルームのファン数）"""
+        counts = np.stack([_popcount(self.bitmaps[i] & self.bitmaps) for i in range(len(self.rooms))]) \
+            if self.rooms else np.zeros((0, 0), dtype=np.int64)
+        return pd.DataFrame(counts, index=pd.Index(self.rooms, name="ルームID"), columns=self.rooms)
+
+    def pairwise_ratio(self):
+        """行のルームのファンのうち、列のルームにもいる割合（%）"""
+        counts = self.pairwise_counts()
+        sizes = np.maximum(self.sizes, 1)[:, None]
+        return (counts / sizes * 100).round(1)
+
+    def count_distribution(self, rooms=None):
+        """「ちょうど k ルームのファン」の人数（k = 1 … ルーム数）"""
+        member = self.membership(rooms)
+        k = member.sum(axis=0)
+        n = member.shape[0]
+        counts = np.bincount(k, minlength=n + 1)[1:]
+        return pd.DataFrame({"共通ルーム数": np.arange(1, n + 1), "人数": counts})
+
+    def shared_fans(self, rooms=None, min_rooms=2, base_room=None):
+        """min_rooms 以上のルームに共通するファンの一覧（レベル合計値の多い順、同値は同順位）
+
+        rooms: 対象ルーム（省略時は全ルーム）。min_rooms=len(rooms) なら全ルーム共通（N-way）。
+        base_room: 指定するとそのルームのファンに限る（「A の上位ファンのうち B・C も支えている人」）。
+        列: 順位, user_id, ユーザー名, 共通ルーム数, レベル合計値, Lv_<ルームID>...
+        """
+        index = self._index(rooms)
+        member = self.membership(rooms)
+        n_shared = member.sum(axis=0)
+        hit = n_shared >= max(min_rooms, 1)
+        if base_room is not None:
+            hit &= self.membership([base_room])[0]
+        cols = np.flatnonzero(hit)
+        levels = self.levels[index][:, cols]
+        df = pd.DataFrame({
+            "user_id": self.user_ids[cols],
+            "ユーザー名": self.names[cols],
+            "共通ルーム数": n_shared[cols],
+            "レベル合計値": levels.sum(axis=0),
+        })
+        for row, i in enumerate(index):
+            df[f"Lv_{self.rooms[i]}"] = levels[row]
+        df.insert(0, "順位", df["レベル合計値"].rank(method="min", ascending=False).astype(int) if len(df) else [])
+        return df.sort_values(["順位", "共通ルーム数", "user_id"], ascending=[True, False, True],
+                              kind="stable").reset_index(drop=True)
+
+
+def matrix_csv(overlap):
+    """共通ファン数の表（人数と割合）をCSVバイト列にする"""
+    counts = overlap.pairwise_counts()
+    ratio = overlap.pairwise_ratio()
+    rows = []
+    for a in overlap.rooms:
+        for b in overlap.rooms:
+            rows.append({"ルームA": a, "ルームB": b, "Aのファン数": int(counts.at[a, a]),
+                         "共通ファン数": int(counts.at[a, b]), "Aに占める割合(%)": float(ratio.at[a, b])})
+    return pd.DataFrame(rows).to_csv(index=False, encoding="utf-8-sig").encode("utf-8-sig")
+
+
+def shared_csv(df):
+    return df.to_csv(index=False, encoding="utf-8-sig").encode("utf-8-sig")
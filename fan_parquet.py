@@ -0,0 +1,154 @@
+import importlib.util
+import os
+
+# pyarrow は任意依存（Parquet 出力を使う場合のみ必要）。読み込みに時間がかかるため、
+# 起動時はインストールの有無だけを調べ、実際に書き出す・読み込むときに import する
+pa = ds = pq = None
+
+# ----- 列指向（Parquet）出力 -----
+# root/
+#   months/ym=YYYYMM/part-0.parquet   月別の全ユーザー（ym は Hive 形式のパーティション）
+#   merge.parquet                     マージ集計
+MONTHS_DIR = "months"
+MERGE_FILE = "merge.parquet"
+DEFAULT_ROWS_PER_GROUP = 64 * 1024
+DEFAULT_COMPRESSION = "zstd"
+
+
+def available():
+    return pa is not None or importlib.util.find_spec("pyarrow") is not None
+
+
+def _require():
+    global pa, ds, pq
+    if pa is not None:
+        return
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Parquet 出力には pyarrow が必要です（pip install pyarrow）")
+    ds, pq = pyarrow.dataset, pyarrow.parquet
+    pa = pyarrow
+
+
+def _month_schema():
+    return pa.schema([
+        ("user_id", pa.int64()),
+        ("level", pa.int16()),
+        ("title_id", pa.int16()),
+        ("avatar_id", pa.int32()),
+        ("user_name", pa.string()),
+        ("position", pa.int32()),    # 月内の位置（offset + ページ内の位置）
+    ])
+
+
+def _merge_schema():
+    return pa.schema([
+        ("avatar_id", pa.int32()),
+        ("level", pa.int32()),
+        ("title_id", pa.int32()),
+        ("user_id", pa.int64()),
+        ("user_name", pa.string()),
+        ("orig_order", pa.int64()),
+    ])
+
+
+def _int(value):
+    return None if value is None or value == "" else int(value)
+
+
+def _merge_table(merge_rows):
+    schema = _merge_schema()
+    data = {name: [] for name in schema.names}
+    for avatar_id, level, title_id, user_id, user_name, orig_order in merge_rows:
+        data["avatar_id"].append(_int(avatar_id))
+        data["level"].append(_int(level))
+        data["title_id"].append(_int(title_id))
+        data["user_id"].append(_int(user_id))
+        data["user_name"].append(user_name)
+        data["orig_order"].append(orig_order)
+    return pa.Table.from_pydict(data, schema=schema)
+
+
+class ParquetDatasetWriter:
+    """ページ単位で受け取ったユーザーを月別パーティションの Parquet へ書き進める
+
+    ページは到着順に書き、行の並びは position 列で復元する。
+    月ごとに rows_per_group 行たまるたびに行グループとして書き出すため、
+    保持するのはその未書き出し分だけ。
+    """
+
+    def __init__(self, root, rows_per_group=DEFAULT_ROWS_PER_GROUP, compression=DEFAULT_COMPRESSION):
+        _require()
+        self.root = root
+        self.rows_per_group = rows_per_group
+        self.compression = compression
+        self.schema = _month_schema()
+        self._buffers = {}
+        self._writers = {}
+        self.rows = {}
+        self.paths = []
+
+    def add_page(self, month, offset, users):
+        buf = self._buffers.get(month)
+        if buf is None:
+            buf = self._buffers[month] = {name: [] for name in self.schema.names}
+        for pos, u in enumerate(users, start=offset):
+            buf["user_id"].append(_int(u.get("user_id")))
+            buf["level"].append(_int(u.get("level")))
+            buf["title_id"].append(_int(u.get("title_id")))
+            buf["avatar_id"].append(_int(u.get("avatar_id")))
+            buf["user_name"].append(u.get("user_name"))
+            buf["position"].append(pos)
+        self.rows[month] = self.rows.get(month, 0) + len(users)
+        if len(buf["position"]) >= self.rows_per_group:
+            self._flush(month)
+
+    def _flush(self, month):
+        buf = self._buffers.pop(month, None)
+        if not buf or not buf["position"]:
+            return
+        writer = self._writers.get(month)
+        if writer is None:
+            part_dir = os.path.join(self.root, MONTHS_DIR, f"ym={month}")
+            os.makedirs(part_dir, exist_ok=True)
+            path = os.path.join(part_dir, "part-0.parquet")
+            writer = self._writers[month] = pq.ParquetWriter(path, self.schema, compression=self.compression)
+            self.paths.append(path)
+        writer.write_table(pa.Table.from_pydict(buf, schema=self.schema))
+
+    def close(self, merge_rows=None):
+        """残りを書き出してファイルを閉じる
+
+        merge_rows: StreamingZipExport.merge_rows() の戻り値（指定時は merge.parquet も書く）
+        戻り値: 出力したファイルのパス一覧
+        """
+        for month in list(self._buffers):
+            self._flush(month)
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+        if merge_rows is not None:
+            os.makedirs(self.root, exist_ok=True)
+            path = os.path.join(self.root, MERGE_FILE)
+            pq.write_table(_merge_table(merge_rows), path, compression=self.compression)
+            self.paths.append(path)
+        return list(self.paths)
+
+
+def load_months(root, months=None):
+    """月別パーティションを DataFrame で読み込む（ym はカテゴリ型、月内は position 順）"""
+    _require()
+    partitioning = ds.partitioning(pa.schema([("ym", pa.string())]), flavor="hive")
+    dataset = ds.dataset(os.path.join(root, MONTHS_DIR), format="parquet", partitioning=partitioning)
+    filter_expr = ds.field("ym").isin([str(m) for m in months]) if months else None
+    df = dataset.to_table(filter=filter_expr).to_pandas()
+    df["ym"] = df["ym"].astype("category")
+    return df.sort_values(["ym", "position"], kind="stable").reset_index(drop=True)
+
+
+def load_merge(root):
+    _require()
+    return pq.read_table(os.path.join(root, MERGE_FILE)).to_pandas()
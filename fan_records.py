@@ -0,0 +1,153 @@
+from array import array
+
+import numpy as np
+import pandas as pd
+
+# ----- セッション内に保持するファンデータの列指向ストア -----
+# APIのJSON（1ユーザー1 dict）のまま持つと1件あたり数百バイトになるため、
+# 型付きの配列と名前の文字列表に詰め替えて保持する。
+MISSING = -1    # 値が欠けている（None）ことを表す番兵
+
+_COLUMNS = (
+    # (列名, array の型コード, numpy の型)
+    ("user_id", "q", np.int64),
+    ("level", "h", np.int16),
+    ("title_id", "h", np.int16),
+    ("avatar_id", "i", np.int32),
+    ("name_code", "i", np.int32),
+)
+
+
+class NameTable:
+    """ユーザー名の文字列表（同じ名前は1つの文字列を共有し、レコード側は番号だけを持つ）"""
+
+    def __init__(self):
+        self.names = []
+        self._codes = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def code(self, name):
+        if name is None:
+            return MISSING
+        code = self._codes.get(name)
+        if code is None:
+            code = self._codes[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+
+def _int(value):
+    return MISSING if value is None or value == "" else int(value)
+
+
+class FanRecords:
+    """1か月分（または1ページ分）のユーザーをオフセット順に保持する型付きの列
+
+    user_id は int64、level / title_id は int16、avatar_id は int32、
+    ユーザー名は NameTable の番号（int32）で持つ。NameTable は月をまたいで共有できる。
+    for で回すとAPIと同じ形の dict を1件ずつ作って返す（リストは作らない）。
+    """
+
+    __slots__ = ("names",) + tuple(name for name, _, _ in _COLUMNS)
+
+    def __init__(self, names=None):
+        self.names = names if names is not None else NameTable()
+        for name, typecode, _ in _COLUMNS:
+            setattr(self, name, array(typecode))
+
+    @classmethod
+    def from_users(cls, users, names=None):
+        records = cls(names)
+        records.extend(users)
+        return records
+
+    def extend(self, users):
+        """APIのユーザー dict のリスト（1ページ分など）を末尾に追加する"""
+        code = self.names.code
+        for u in users:
+            self.user_id.append(_int(u.get("user_id")))
+            self.level.append(_int(u.get("level")))
+            self.title_id.append(_int(u.get("title_id")))
+            self.avatar_id.append(_int(u.get("avatar_id")))
+            self.name_code.append(code(u.get("user_name")))
+
+    def extend_records(self, other):
+        """別の FanRecords を末尾に追加する（NameTable が異なる場合は名前の番号を付け替える）"""
+        for name, _, _ in _COLUMNS:
+            if name != "name_code":
+                getattr(self, name).extend(getattr(other, name))
+        if other.names is self.names:
+            self.name_code.extend(other.name_code)
+            return
+        codes = other.column("name_code")
+        used, inverse = np.unique(codes, return_inverse=True)
+        src, code = other.names.names, self.names.code
+        remap = np.array([MISSING if c == MISSING else code(src[c]) for c in used.tolist()], dtype=np.int32)
+        self.name_code.frombytes(remap[inverse].astype(np.int32).tobytes())
+
+    def copy(self, names=None):
+        """names（省略時は新しい NameTable）に名前を付け替えた複製"""
+        records = FanRecords(names)
+        records.extend_records(self)
+        return records
+
+    def __len__(self):
+        return len(self.user_id)
+
+    def __iter__(self):
+        names = self.names.names
+
+        def value(v):
+            return None if v == MISSING else v
+
+        for uid, lv, t, a, c in zip(self.user_id, self.level, self.title_id, self.avatar_id, self.name_code):
+            yield {"avatar_id": value(a), "level": value(lv), "title_id": value(t), "user_id": value(uid),
+                   "user_name": names[c] if c != MISSING else None}
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).itemsize * len(self) for name, _, _ in _COLUMNS)
+
+    def column(self, name):
+        """列を numpy 配列として返す（コピーしない読み取り専用ビュー）"""
+        dtype = dict((n, t) for n, _, t in _COLUMNS)[name]
+        values = np.frombuffer(getattr(self, name), dtype=dtype)
+        values.flags.writeable = False
+        return values
+
+    def unique_user_count(self):
+        return len(np.unique(self.column("user_id")))
+
+
+def records_frame(month_records):
+    """{ym: FanRecords}（NameTable を共有していること）を1つの DataFrame にする
+
+    列: user_id, level, title_id, avatar_id, user_name（カテゴリ）, ym（カテゴリ）。
+    各列は月をまたいで1回連結するだけで、行ごとの dict は作らない。
+    level が欠けているレコードは 0、その他の欠損は -1 になる。
+    """
+    months = [ym for ym, records in month_records.items() if len(records)]
+    if not months:
+        return pd.DataFrame(columns=["user_id", "level", "title_id", "avatar_id", "user_name", "ym"])
+    parts = [month_records[ym] for ym in months]
+    table = parts[0].names
+    if any(records.names is not table for records in parts):
+        raise ValueError("records_frame には NameTable を共有した FanRecords を渡してください")
+
+    def concat(name):
+        return np.concatenate([records.column(name) for records in parts])
+
+    level = concat("level")
+    level[level == MISSING] = 0
+    sizes = [len(records) for records in parts]
+    return pd.DataFrame({
+        "user_id": concat("user_id"),
+        "level": level,
+        "title_id": concat("title_id"),
+        "avatar_id": concat("avatar_id"),
+        "user_name": pd.Categorical.from_codes(concat("name_code"), categories=pd.Index(table.names, dtype=object)),
+        "ym": pd.Categorical.from_codes(np.repeat(np.arange(len(months), dtype=np.int32), sizes),
+                                        categories=months),
+    }, copy=False)
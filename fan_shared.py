@@ -0,0 +1,125 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import fan_cache
+
+# ----- プロセス内で全セッションが共有する月別ユーザーのキャッシュ -----
+# 同じルーム・月を複数セッションが同時に開いても、クロールは1回だけ行う（single-flight）。
+# 保持量はバイト数で上限を設け、超えた分は最後に使われた時刻の古い月から捨てる（LRU）。
+DEFAULT_MAX_BYTES = int(os.environ.get("SR_FAN_SHARED_CACHE_MB", "256")) * 1024 * 1024
+
+
+class SharedMonthCache:
+    """(room_id, ym, count) 単位の全ユーザーを FanRecords で保持する
+
+    count（先頭ページの件数）もキーに含めるため、件数が変わった月は別物として扱う。
+    有効期限は fan_cache.is_fresh() と同じ（月が締まる前に取得したデータは TTL で期限切れになる）。
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()     # {(room_id, ym): (count, FanRecords, stored_at, nbytes)}
+        self._in_flight = {}              # {(room_id, ym, count): threading.Event}
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    # --- キャッシュ本体 ---
+    def load(self, room_id, ym, count, names=None):
+        """保持していれば names（NameTable）に付け替えた FanRecords の複製を返す（なければ None）"""
+        key = (str(room_id), str(ym))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != count or not fan_cache.is_fresh(ym, entry[2]):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            records = entry[1]
+        return records.copy(names)
+
+    def store(self, room_id, ym, count, records, stored_at=None):
+        """stored_at: 取得した時刻の time.time() 値（省略時は現在時刻。ディスクから読んだ月はその保存時刻を渡す）"""
+        # セッション側の NameTable（他の月の名前も含む）を抱え込まないよう、専用の表に付け替えて持つ
+        records = records.copy()
+        nbytes = records.nbytes + sum(sys.getsizeof(n) for n in records.names.names)
+        if nbytes > self.max_bytes:
+            return
+        key = (str(room_id), str(ym))
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[3]
+            self._entries[key] = (count, records, stored_at or time.time(), nbytes)
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted[3]
+                self.evictions += 1
+
+    def invalidate(self, room_id, months=None):
+        room_id = str(room_id)
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == room_id and (not months or k[1] in months)]:
+                self.bytes -= self._entries.pop(key)[3]
+
+    # --- single-flight ---
+    def claim(self, room_id, month_counts):
+        """取得担当を決める
+
+        戻り値: (自分がクロールする月のリスト, {他のセッションが取得中の月: 完了を待つ Event})
+        自分の担当分は取得後に必ず release() すること。
+        """
+        mine, waiting = [], {}
+        with self._lock:
+            for ym, count in month_counts.items():
+                key = (str(room_id), str(ym), count)
+                event = self._in_flight.get(key)
+                if event is None:
+                    self._in_flight[key] = threading.Event()
+                    mine.append(ym)
+                else:
+                    waiting[ym] = event
+                    self.coalesced += 1
+        return mine, waiting
+
+    def release(self, room_id, month_counts):
+        with self._lock:
+            events = [self._in_flight.pop((str(room_id), str(ym), count), None)
+                      for ym, count in month_counts.items()]
+        for event in events:
+            if event is not None:
+                event.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "in_flight": len(self._in_flight),
+            }
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def get_shared_cache():
+    """プロセス内で共有するキャッシュ（Streamlit の全セッション・fan_batch の全ジョブで共通）"""
+    global _shared
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                _shared = SharedMonthCache()
+    return _shared
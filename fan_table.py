@@ -0,0 +1,58 @@
+import html
+
+import streamlit as st
+
+# ----- HTMLテーブル描画（統計データ一覧・マージ集計で共通利用） -----
+AVATAR_URL = "https://static.showroom-live.com/image/avatar/{}.png"
+
+
+def _format_column(values, fmt):
+    if fmt == "comma":
+        return values.map(lambda v: f"{v:,}")
+    if fmt == "avatar":
+        # 画面外の画像は表示直前まで読み込まない
+        return values.map(lambda v: f"<img src='{AVATAR_URL.format(html.escape(str(v)))}' width='40' loading='lazy'>")
+    return values.map(lambda v: html.escape(str(v)))
+
+
+def build_table_html(df, columns, table_style="width:100%; border-collapse:collapse;",
+                     header_row_style="", row_style="", wrapper_style=None):
+    """DataFrame から <table> のマークアップを列単位でまとめて生成する
+
+    columns: [{"key": 列名, "label": 見出し, "th_style": ..., "td_style": ...,
+               "format": "text" | "comma" | "avatar"}, ...]
+    text 形式の値は html.escape してから埋め込む。
+    """
+    head = "".join(
+        f"<th style='{c.get('th_style', '')}'>{html.escape(c['label'])}</th>" for c in columns
+    )
+    if len(df):
+        cells = None
+        for c in columns:
+            col = f"<td style='{c.get('td_style', '')}'>" + _format_column(df[c["key"]], c.get("format", "text")) + "</td>"
+            cells = col if cells is None else cells + col
+        rows = f"<tr style='{row_style}'>" + cells + "</tr>"
+        body = "".join(rows)
+    else:
+        body = ""
+    table = (
+        f"<table style='{table_style}'><thead><tr style='{header_row_style}'>{head}</tr></thead>"
+        f"<tbody>{body}</tbody></table>"
+    )
+    if wrapper_style is not None:
+        table = f"<div style='{wrapper_style}'>{table}</div>"
+    return table
+
+
+def show_paged_table(df, columns, key, page_size=100, **table_kwargs):
+    """page_size 行ずつページ分けして表示する（1ページ分のHTMLだけを送る）"""
+    total_pages = max((len(df) + page_size - 1) // page_size, 1)
+    page = 1
+    if total_pages > 1:
+        page = st.number_input(
+            f"ページ（全 {total_pages} ページ / {len(df):,} 件）",
+            min_value=1, max_value=total_pages, value=1, step=1, key=key
+        )
+    start = (page - 1) * page_size
+    st.markdown(build_table_html(df.iloc[start:start + page_size], columns, **table_kwargs), unsafe_allow_html=True)
+    return page
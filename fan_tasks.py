@@ -0,0 +1,198 @@
+import shutil
+import tempfile
+
+import pandas as pd
+
+import fan_parquet
+import showroom_client
+from fan_analysis import build_level_matrix, top_competition_ranking
+from fan_dataset import FanDataset
+from fan_export import DEFAULT_COMPRESSION, StreamingZipExport
+from fan_overlap import FanOverlap, RoomFanSet
+from fan_telemetry import Telemetry
+
+# ----- バックグラウンドジョブの本体（fan_jobs.JobManager のワーカーで実行する） -----
+# 画面の部品には触らず、進捗は job.update() で書き込み、結果は戻り値で返す。
+# ジョブごとに新しい FanDataset を使う（取得済みの月は共有キャッシュ・ディスクキャッシュから読まれる）。
+MERGE_COLUMNS = ['avatar_id', 'level', 'title_id', 'user_id', 'user_name', 'orig_order']
+
+PHASE_HEADERS = "先頭ページ取得"
+PHASE_PAGES = "全ページ取得"
+PHASE_FINISH = "集計・書き出し"
+
+
+def _prepare(job, dataset, months, incremental, stats, telemetry):
+    """先頭ページを取得して {ym: count} を返す（差分更新時は再取得が必要な月も返す）"""
+    job.update(phase=PHASE_HEADERS)
+    changed_months = None
+    if incremental:
+        with telemetry.stage("先頭ページ取得（差分確認）"):
+            changed_months = dataset.sync(months, stats=stats, telemetry=telemetry)
+    else:
+        with telemetry.stage("先頭ページ取得"):
+            dataset.ensure_headers(months, stats=stats, telemetry=telemetry)
+    counts = {month: dataset.count(month) for month in months}
+    job.update(phase=PHASE_PAGES, counts=dict(counts), retrieved={month: 0 for month in months},
+               total=sum(counts.values()), done=0)
+    return counts, changed_months
+
+
+def _progress_callback(job, months, inner=None):
+    """ページ到着ごとに月別・全体の取得件数を job に書き込む on_page を作る"""
+    retrieved = {month: 0 for month in months}
+
+    def on_page(month, offset, users):
+        if inner is not None:
+            inner(month, offset, users)
+        retrieved[month] += len(users)
+        job.update(retrieved=dict(retrieved), done=sum(retrieved.values()))
+
+    return on_page, retrieved
+
+
+def zip_task(job, room_id, months, incremental=False, parquet=False, top_n=1000, compression=DEFAULT_COMPRESSION):
+    """全ページを取得して月別CSV・マージCSV（と任意で Parquet）の ZIP を作る
+
+    compression: fan_export.COMPRESSION_CODECS のキー
+    """
+    months = list(months)
+    stats = showroom_client.new_stats()
+    telemetry = Telemetry(f"ZIP作成 {room_id}")
+    dataset = FanDataset(room_id)
+    counts, changed_months = _prepare(job, dataset, months, incremental, stats, telemetry)
+
+    # 取得したページはその場で月別CSVへ書き込み、マージ集計も逐次更新する
+    zip_export = StreamingZipExport(room_id, months, compression=compression)
+    for month in months:
+        zip_export.expect(month, counts[month])
+    parquet_dir = tempfile.mkdtemp(prefix="fan_parquet_") if parquet else None
+    parquet_writer = fan_parquet.ParquetDatasetWriter(parquet_dir) if parquet else None
+
+    def write_page(month, offset, users):
+        zip_export.add_page(month, offset, users)
+        if parquet_writer is not None:
+            parquet_writer.add_page(month, offset, users)
+
+    on_page, retrieved = _progress_callback(job, months, write_page)
+    try:
+        with telemetry.stage("全ページ取得・月別CSV書き込み"):
+            dataset.ensure_users(months, on_page=on_page, stats=stats, telemetry=telemetry)
+        job.update(phase=PHASE_FINISH)
+        with telemetry.stage("完全性チェック"):
+            completeness = dataset.completeness(months)
+
+        # 月別CSVの残りとマージCSVを書き出してアーカイブを閉じる
+        has_fans = bool(zip_export.agg)
+        if parquet_writer is not None:
+            with telemetry.stage("Parquet書き出し"):
+                parquet_writer.close(merge_rows=zip_export.merge_rows() if has_fans else None)
+                zip_export.add_tree(parquet_dir, "parquet")
+        with telemetry.stage("ZIP作成（マージCSV含む）"):
+            zip_buffer = zip_export.finish(completeness=completeness)
+            zip_bytes = zip_buffer.read()
+            zip_buffer.close()
+    finally:
+        if parquet_dir is not None:
+            shutil.rmtree(parquet_dir, ignore_errors=True)
+
+    merge_top = None
+    merge_rows = 0
+    if has_fans:
+        with telemetry.stage("マージ集計"):
+            agg_df = pd.DataFrame(zip_export.merge_rows(), columns=MERGE_COLUMNS)
+        merge_rows = len(agg_df)
+        # 同レベル同順位の競技順位を配列演算で付け、上位だけを部分選択する
+        with telemetry.stage("マージ順位付け"):
+            merge_top = top_competition_ranking(agg_df, k=top_n)
+        merge_top = merge_top[['順位', 'avatar_id', 'level', 'user_name']]
+
+    return {
+        "zip_bytes": zip_bytes if has_fans else None,
+        "file_name": f"active_fans_{room_id}.zip",
+        "merge_top": merge_top,
+        "merge_rows": merge_rows,
+        "month_rows": dict(retrieved),
+        "completeness": completeness,
+        "failed_months": sorted(dataset.failed_months(months)),
+        "header_failed": dataset.header_failed_months(months),
+        "changed_months": changed_months,
+        "stats": stats,
+        "telemetry": telemetry,
+    }
+
+
+def detail_task(job, room_id, months, incremental=False):
+    """全ページを取得してユーザー×月のレベル行列を作る（詳細分析用）"""
+    months = sorted(months)
+    stats = showroom_client.new_stats()
+    telemetry = Telemetry(f"詳細分析 {room_id}")
+    dataset = FanDataset(room_id)
+    _prepare(job, dataset, months, incremental, stats, telemetry)
+
+    on_page, _ = _progress_callback(job, months)
+    with telemetry.stage("全ページ取得"):
+        dataset.ensure_users(months, on_page=on_page, stats=stats, telemetry=telemetry)
+    job.update(phase=PHASE_FINISH)
+    with telemetry.stage("完全性チェック"):
+        completeness = dataset.completeness(months)
+    with telemetry.stage("行データ作成"):
+        # 型付きの列を月をまたいで連結するだけで、行ごとの dict は作らない
+        analysis_frame = dataset.frame(months)
+    # ユーザー×月のレベル行列を一度だけ作り、画面側はこれから各分析を導出する
+    with telemetry.stage("集計（レベル行列の作成）"):
+        fan_matrix = build_level_matrix(analysis_frame) if len(analysis_frame) else None
+
+    return {
+        "fan_matrix": fan_matrix,
+        "completeness": completeness,
+        "failed_pages": sum(len(dataset.failed.get(m, [])) for m in months),
+        "header_failed": dataset.header_failed_months(months),
+        "stats": stats,
+        "telemetry": telemetry,
+    }
+
+
+def overlap_task(job, room_ids, months, incremental=False):
+    """複数ルームの全ページを順に取得し、ファン集合の重複（fan_overlap.FanOverlap）を作る
+
+    進捗の counts / retrieved はルーム単位（各ルームの選択月の合計件数）で書き込む。
+    """
+    months = sorted(months)
+    stats = showroom_client.new_stats()
+    telemetry = Telemetry(f"重複分析 {len(room_ids)}ルーム")
+    datasets = {room_id: FanDataset(room_id) for room_id in room_ids}
+
+    job.update(phase=PHASE_HEADERS)
+    with telemetry.stage("先頭ページ取得"):
+        for room_id, dataset in datasets.items():
+            if incremental:
+                dataset.sync(months, stats=stats, telemetry=telemetry)
+            else:
+                dataset.ensure_headers(months, stats=stats, telemetry=telemetry)
+    counts = {room_id: sum(dataset.count(m) for m in months) for room_id, dataset in datasets.items()}
+    retrieved = {room_id: 0 for room_id in room_ids}
+    job.update(phase=PHASE_PAGES, counts=dict(counts), retrieved=dict(retrieved),
+               total=sum(counts.values()), done=0)
+
+    fan_sets = []
+    for room_id, dataset in datasets.items():
+        def on_page(month, offset, users, room_id=room_id):
+            retrieved[room_id] += len(users)
+            job.update(retrieved=dict(retrieved), done=sum(retrieved.values()))
+
+        with telemetry.stage(f"全ページ取得 {room_id}"):
+            dataset.ensure_users(months, on_page=on_page, stats=stats, telemetry=telemetry)
+        fan_sets.append(RoomFanSet.from_frame(room_id, dataset.frame(months)))
+
+    job.update(phase=PHASE_FINISH)
+    with telemetry.stage("重複の集計"):
+        overlap = FanOverlap(fan_sets)
+
+    return {
+        "overlap": overlap,
+        "failed_months": {room_id: sorted(dataset.failed_months(months))
+                          for room_id, dataset in datasets.items() if dataset.failed_months(months)},
+        "completeness": {room_id: dataset.completeness(months) for room_id, dataset in datasets.items()},
+        "stats": stats,
+        "telemetry": telemetry,
+    }
@@ -0,0 +1,125 @@
+import csv
+import io
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# ----- 取得・分析処理の計測（どこで時間がかかっているかを見るための記録） -----
+REQUEST_FIELDS = ["room_id", "ym", "offset", "limit", "wait_sec", "latency_sec", "parse_sec",
+                  "bytes", "retries", "users", "error"]
+CSV_COLUMNS = ["kind", "name", "seconds"] + REQUEST_FIELDS
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(len(sorted_values) * q), len(sorted_values) - 1)]
+
+
+class Telemetry:
+    """1回の操作（詳細分析・ZIP作成・一括取得）の計測結果
+
+    - requests: 1リクエストごとの送信待ち・レイテンシ・JSON解析時間・バイト数・再試行回数
+    - skipped: 再試行後も取得できずに飛ばしたページ
+    - stages: 処理段階ごとの所要時間（同じ段階は最新の計測値で上書き）
+    ワーカースレッドから記録されるためロックで保護する。
+    """
+
+    def __init__(self, label=""):
+        self.label = label
+        self.started_at = time.time()
+        self.requests = []
+        self.skipped = []
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def record_request(self, **fields):
+        row = {k: fields.get(k) for k in REQUEST_FIELDS}
+        with self._lock:
+            self.requests.append(row)
+
+    def record_skipped(self, room_id, ym, offset, error):
+        with self._lock:
+            self.skipped.append({"room_id": room_id, "ym": ym, "offset": offset, "error": str(error)})
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            with self._lock:
+                self.stages[name] = seconds
+
+    def summary(self):
+        with self._lock:
+            requests = list(self.requests)
+            skipped = len(self.skipped)
+            stage_sec = sum(self.stages.values())
+        latencies = sorted(r["latency_sec"] or 0.0 for r in requests)
+        return {
+            "requests": len(requests),
+            "retries": sum(r["retries"] or 0 for r in requests),
+            "errors": sum(1 for r in requests if r["error"]),
+            "skipped_pages": skipped,
+            "bytes": sum(r["bytes"] or 0 for r in requests),
+            "latency_p50_sec": round(_percentile(latencies, 0.5), 4),
+            "latency_p95_sec": round(_percentile(latencies, 0.95), 4),
+            "latency_max_sec": round(latencies[-1], 4) if latencies else 0.0,
+            "latency_total_sec": round(sum(latencies), 3),
+            "wait_total_sec": round(sum(r["wait_sec"] or 0.0 for r in requests), 3),
+            "parse_total_sec": round(sum(r["parse_sec"] or 0.0 for r in requests), 3),
+            "stage_total_sec": round(stage_sec, 3),
+        }
+
+    def stage_rows(self):
+        with self._lock:
+            return [{"段階": name, "秒": round(sec, 3)} for name, sec in self.stages.items()]
+
+    def to_dict(self):
+        with self._lock:
+            requests = list(self.requests)
+            skipped = list(self.skipped)
+            stages = {name: round(sec, 4) for name, sec in self.stages.items()}
+        return {
+            "label": self.label,
+            "started_at": self.started_at,
+            "summary": self.summary(),
+            "stages": stages,
+            "requests": requests,
+            "skipped": skipped,
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), ensure_ascii=False, indent=2)
+
+    def write_csv(self, f):
+        """段階・リクエスト・スキップしたページを kind 列で区別して1つの表に書く"""
+        writer = csv.DictWriter(f, fieldnames=CSV_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        data = self.to_dict()
+        for name, sec in data["stages"].items():
+            writer.writerow({"kind": "stage", "name": name, "seconds": sec})
+        for r in data["requests"]:
+            writer.writerow(dict(r, kind="request", seconds=r["latency_sec"]))
+        for r in data["skipped"]:
+            writer.writerow(dict(r, kind="skipped"))
+
+    def to_csv(self):
+        buf = io.StringIO()
+        self.write_csv(buf)
+        return buf.getvalue()
+
+    def save(self, path):
+        """拡張子が .csv なら CSV、それ以外は JSON で保存する"""
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            if path.lower().endswith(".csv"):
+                self.write_csv(f)
+            else:
+                f.write(self.to_json())
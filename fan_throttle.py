@@ -0,0 +1,160 @@
+import json
+import os
+import threading
+import time
+
+import fan_cache
+import showroom_client
+
+# ----- アクティブファンAPI向けの適応制御（ページサイズ・同時接続数・送信間隔） -----
+SETTINGS_PATH = os.environ.get(
+    "SR_FAN_THROTTLE_PATH",
+    os.path.join(os.path.dirname(fan_cache.CACHE_PATH) or ".", "throttle.json")
+)
+
+BASE_PAGE_SIZE = 50                       # API が確実に受け付ける件数（従来の per_page）
+PAGE_SIZE_CANDIDATES = (1000, 500, 200, 100)
+PAGE_SIZE_REPROBE_SEC = 7 * 24 * 3600
+
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = showroom_client.POOL_MAXSIZE
+MAX_DELAY = 5.0                           # スロットリング時に上乗せする送信間隔の上限
+TARGET_LATENCY = 1.5                      # これより遅いレスポンスが続いたら同時数を下げる
+
+
+class AdaptiveController:
+    """AIMD 方式で同時接続数と送信間隔を調整し、受け付けられる最大ページサイズを記憶する
+
+    - 429/5xx・通信エラー（クライアントが再試行したリクエスト）: 同時数を半減、間隔を倍
+    - 目標レイテンシ内の成功が同時数ぶん続く: 同時数 +1、間隔を半減（最終的に0）
+    - 送信間隔は呼び出し側の下限（1秒あたりの上限回数）を下回らない
+    - 学習した値は JSON に保存し、次回起動時に引き継ぐ
+    """
+
+    def __init__(self, page_size=BASE_PAGE_SIZE, concurrency=4.0, delay=0.0,
+                 page_size_checked_at=0.0, path=None):
+        self.page_size = int(page_size)
+        self.concurrency = float(concurrency)
+        self.delay = float(delay)
+        self.page_size_checked_at = float(page_size_checked_at)
+        self.path = path
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._next_at = 0.0
+        self._successes = 0
+
+    # --- 送信制御 ---
+    def acquire(self, max_concurrency=MAX_CONCURRENCY, min_delay=0.0):
+        """送信枠が空くまで待ち、前回の送信から max(delay, min_delay) 秒空ける"""
+        with self._cond:
+            while self._in_flight >= max(MIN_CONCURRENCY, min(int(self.concurrency), max_concurrency)):
+                self._cond.wait()
+            self._in_flight += 1
+            now = time.monotonic()
+            wait_sec = self._next_at - now
+            self._next_at = max(now, self._next_at) + max(self.delay, min_delay)
+        if wait_sec > 0:
+            time.sleep(wait_sec)
+
+    def release(self, latency, throttled):
+        with self._cond:
+            self._in_flight -= 1
+            if throttled:
+                self.concurrency = max(MIN_CONCURRENCY, self.concurrency / 2)
+                self.delay = min(MAX_DELAY, max(self.delay * 2, 0.1))
+                self._successes = 0
+            elif latency <= TARGET_LATENCY:
+                self._successes += 1
+                if self._successes >= int(self.concurrency):
+                    self.concurrency = min(MAX_CONCURRENCY, self.concurrency + 1)
+                    self.delay = self.delay / 2 if self.delay > 0.01 else 0.0
+                    self._successes = 0
+            else:
+                self.concurrency = max(MIN_CONCURRENCY, self.concurrency - 1)
+                self._successes = 0
+            self._cond.notify_all()
+
+    # --- ページサイズ ---
+    def needs_page_size_probe(self):
+        return time.time() - self.page_size_checked_at >= PAGE_SIZE_REPROBE_SEC
+
+    def probe_page_size(self, fetch_users, count):
+        """limit を大きい順に試し、要求どおりの件数が返ってきた最大値を採用する
+
+        fetch_users(limit) は offset=0 で limit 件を要求し、ユーザー一覧を返す関数。
+        count 未満の limit しか検証できないため、件数の少ない月では判定しない。
+        """
+        tested = False
+        for limit in PAGE_SIZE_CANDIDATES:
+            if count < limit:
+                continue
+            tested = True
+            try:
+                if len(fetch_users(limit)) == limit:
+                    self._set_page_size(limit)
+                    return self.page_size
+            except Exception:
+                continue
+        if tested:
+            # どの候補も受け付けられなかった場合は従来の件数に戻す
+            self._set_page_size(BASE_PAGE_SIZE)
+        return self.page_size
+
+    def report_short_page(self, returned):
+        """途中のページで要求より少ない件数が返った場合、その件数まで下げる"""
+        if returned > 0:
+            self._set_page_size(min(self.page_size, returned))
+
+    def _set_page_size(self, size):
+        with self._cond:
+            self.page_size = int(size)
+            self.page_size_checked_at = time.time()
+
+    # --- 永続化 ---
+    def to_dict(self):
+        return {
+            "page_size": self.page_size,
+            "concurrency": round(self.concurrency, 2),
+            "delay": round(self.delay, 4),
+            "page_size_checked_at": self.page_size_checked_at,
+        }
+
+    def save(self):
+        if not self.path:
+            return
+        try:
+            dirname = os.path.dirname(self.path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.to_dict(), f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            # 保存できなくても取得処理は続ける
+            pass
+
+
+def load_controller(path=SETTINGS_PATH):
+    settings = {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            settings = json.load(f)
+    except (OSError, ValueError):
+        pass
+    known = ("page_size", "concurrency", "delay", "page_size_checked_at")
+    return AdaptiveController(path=path, **{k: settings[k] for k in known if k in settings})
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_controller():
+    """プロセス内で共有する制御器（上流APIの状態は全セッション共通のため）"""
+    global _controller
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                _controller = load_controller()
+    return _controller
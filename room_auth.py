@@ -0,0 +1,72 @@
+import csv
+import io
+import threading
+import time
+
+import showroom_client
+
+# ----- 認証用ルームリスト（room_list.csv）のインデックス -----
+ROOM_LIST_TTL_SEC = 10 * 60
+
+
+def parse_room_list(text):
+    """CSV 1列目の値を前後空白除去した frozenset にする"""
+    codes = set()
+    for row in csv.reader(io.StringIO(text)):
+        if row and row[0].strip():
+            codes.add(row[0].strip())
+    return frozenset(codes)
+
+
+class RoomListIndex:
+    """ルームリストを保持し、TTL 経過後は裏で再取得する
+
+    初回のみ同期で取得し、以降は期限切れでも手元の一覧で即答しつつ
+    バックグラウンドスレッドで更新する（再描画のたびに CSV を取得しない）。
+    """
+
+    def __init__(self, url, ttl_sec=ROOM_LIST_TTL_SEC):
+        self.url = url
+        self.ttl_sec = ttl_sec
+        self._codes = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _load(self):
+        resp = showroom_client.get(self.url)
+        resp.raise_for_status()
+        codes = parse_room_list(resp.text)
+        with self._lock:
+            self._codes = codes
+            self._loaded_at = time.time()
+        return codes
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def _run():
+            try:
+                self._load()
+            except Exception:
+                # 取得失敗時は手元の一覧を使い続け、次回アクセス時に再試行する
+                pass
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=_run, name="room-list-refresh", daemon=True).start()
+
+    def codes(self):
+        """現在の認証コード一覧（初回取得に失敗した場合は例外を送出）"""
+        if self._codes is None:
+            return self._load()
+        if time.time() - self._loaded_at >= self.ttl_sec:
+            self._refresh_in_background()
+        return self._codes
+
+    def __contains__(self, code):
+        return str(code).strip() in self.codes()
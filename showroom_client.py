@@ -0,0 +1,131 @@
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# ----- 共通HTTPクライアント設定 -----
+DEFAULT_TIMEOUT = (5, 15)          # (接続, 読み込み) 秒
+POOL_CONNECTIONS = 4               # 保持するホスト別プール数
+POOL_MAXSIZE = 8                   # 1ホストあたりの同時接続上限
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5                 # 秒。attempt ごとに倍々で増やす
+BACKOFF_MAX = 8.0
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+_session = None
+_session_lock = threading.Lock()
+_stats_lock = threading.Lock()
+
+
+def new_stats():
+    """リクエスト統計用のカウンタ（呼び出し単位で集計したい場合に使う）
+
+    bytes は受信したレスポンス本文の合計、parse_sec は JSON 解析にかかった秒数。
+    """
+    return {"requests": 0, "retries": 0, "failures": 0, "bytes": 0, "parse_sec": 0.0}
+
+
+_global_stats = new_stats()
+
+
+def get_session():
+    """プロセス内で共有する keep-alive 付きセッションを返す"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                # pool_block=True でホストごとの接続数を POOL_MAXSIZE に抑える
+                adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                                      pool_block=True, max_retries=0)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers.update({"User-Agent": "sr-fanlist-collector"})
+                _session = session
+    return _session
+
+
+def _count(stats, key, n=1):
+    with _stats_lock:
+        _global_stats[key] += n
+        if stats is not None:
+            stats[key] += n
+
+
+def merge_stats(dest, src):
+    """src のカウントを dest に加算する（dest が None なら何もしない）"""
+    if dest is None:
+        return
+    with _stats_lock:
+        for key, n in src.items():
+            dest[key] += n
+
+
+def get_stats():
+    """プロセス全体の累計（new_stats() と同じキー）"""
+    with _stats_lock:
+        return dict(_global_stats)
+
+
+def _backoff_delay(attempt, resp=None):
+    # 429 等で Retry-After が返ってきた場合はそれを優先
+    if resp is not None:
+        retry_after = resp.headers.get("Retry-After")
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), BACKOFF_MAX)
+    # 指数バックオフ + フルジッター
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+def get(url, params=None, timeout=DEFAULT_TIMEOUT, max_retries=MAX_RETRIES, stats=None):
+    """共有セッションで GET する。429/5xx と通信エラーは指数バックオフで再試行する
+
+    再試行を使い切った場合、ステータス異常はそのレスポンスを返し、
+    通信エラーは最後の例外をそのまま送出する。
+    """
+    session = get_session()
+    attempt = 0
+    while True:
+        _count(stats, "requests")
+        try:
+            resp = session.get(url, params=params, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt >= max_retries:
+                _count(stats, "failures")
+                raise
+            _count(stats, "retries")
+            time.sleep(_backoff_delay(attempt))
+            attempt += 1
+            continue
+
+        if resp.status_code in RETRY_STATUS and attempt < max_retries:
+            _count(stats, "retries")
+            time.sleep(_backoff_delay(attempt, resp))
+            attempt += 1
+            continue
+
+        _count(stats, "bytes", len(resp.content))
+        if resp.status_code >= 400:
+            _count(stats, "failures")
+        return resp
+
+
+def is_throttle_error(exc):
+    """サーバー側の混雑を示す失敗か（429・5xx・タイムアウト）。404 や JSON 解析エラー等は含まない"""
+    if isinstance(exc, requests.Timeout):
+        return True
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return False
+
+
+def get_json(url, params=None, timeout=DEFAULT_TIMEOUT, stats=None):
+    """get() してステータスを検査した上で JSON を返す"""
+    resp = get(url, params=params, timeout=timeout, stats=stats)
+    resp.raise_for_status()
+    started = time.perf_counter()
+    data = resp.json()
+    _count(stats, "parse_sec", time.perf_counter() - started)
+    return data
@@ -1,26 +1,324 @@
 import streamlit as st
-import requests
-import pandas as pd
-from io import BytesIO
-from zipfile import ZipFile
 from datetime import datetime
-import time
-import io
-from dateutil.relativedelta import relativedelta
-import plotly.graph_objects as go 
-import html # スクリプトの冒頭でインポート
+from contextlib import nullcontext
+import fan_cache
+import fan_parquet
+from auth_page import get_room_index, show_auth_page
+from fan_completeness import STATUS_COMPLETE, incomplete_months
+from fan_export import COMPRESSION_CODECS, DEFAULT_COMPRESSION
+from fan_jobs import DONE as JOB_DONE, FAILED as JOB_FAILED, STATUS_LABELS as JOB_STATUS_LABELS, get_job_manager
+from fan_table import build_table_html, show_paged_table
+# pandas・plotly・分析／取得処理（fan_dataset, fan_analysis, fan_tasks, fan_overlap など）は
+# 読み込みに時間がかかるため、認証画面や入力だけの画面では import せず、使う箇所で初めて読み込む
 
 # ページ設定
 st.set_page_config(page_title="SHOWROOM ファンリスト取得", layout="wide")
 
-# ----- 認証用のルームリストURL -----
-ROOM_LIST_URL = "https://mksoul-pro.com/showroom/file/room_list.csv"
+# 月選択の最初の月
+FIRST_MONTH = "202309"
+
+# マージ集計の表示件数（1ページあたり MERGE_PAGE_SIZE 行ずつ描画）
+MERGE_TOP_N = 1000
+MERGE_PAGE_SIZE = 100
+
+# 重複分析で一度に扱えるルーム数
+MAX_OVERLAP_ROOMS = 20
+
+# ZIPの圧縮形式の表示名（fan_export.COMPRESSION_CODECS のキー）
+COMPRESSION_LABELS = {
+    "deflate": "deflate（標準・推奨）",
+    "bzip2": "bzip2（高圧縮）",
+    "lzma": "lzma（最高圧縮・展開には7-Zip等が必要）",
+    "zstd": "zstd（高速・展開には対応ソフトが必要）",
+    "stored": "無圧縮",
+}
+
+# バックグラウンドジョブの進捗を描き直す間隔（秒）
+JOB_POLL_SEC = 1.0
+
+
+@st.cache_data(show_spinner=False)
+def month_options(current_ym):
+    """月選択の選択肢（current_ym から FIRST_MONTH まで新しい順）。月が変わるまでは同じ一覧を使い回す"""
+    first = int(FIRST_MONTH[:4]) * 12 + int(FIRST_MONTH[4:]) - 1
+    last = int(current_ym[:4]) * 12 + int(current_ym[4:]) - 1
+    return [f"{i // 12}{i % 12 + 1:02d}" for i in range(last, first - 1, -1)]
+
+
+@st.cache_data(ttl=fan_cache.CURRENT_MONTH_TTL_SEC, show_spinner=False)
+def build_stats_view(room_id, months):
+    """月別サマリの取得とグラフ・表・CSVの生成を (room_id, months) 単位でメモ化する
+
+    戻り値: ((Plotly Figure, 統計テーブルHTML, 統計CSVバイト列), 先頭ページを取得できなかった月のリスト)。
+    取得できた月がなければ前者は None。取得できなかった月がある結果は呼び出し側でメモから消す。
+    """
+    import pandas as pd
+    import plotly.graph_objects as go
+    from fan_dataset import FanDataset
+
+    dataset = FanDataset(room_id)
+    dataset.ensure_headers(list(months))
+    failed = [m for m in months if m not in dataset.headers]
+    stats_list = [dataset.summary(m) for m in months if dataset.summary(m) is not None]
+    if not stats_list:
+        return None, failed
+    df_stats = pd.DataFrame(stats_list)
+
+    # --- グラフ作成（Plotly 2軸） ---
+    fig = go.Figure()
+    fig.add_trace(go.Bar(
+        x=df_stats["年月"], y=df_stats["ファン数"],
+        name="ファン数", marker_color='rgba(55, 128, 191, 0.7)',
+        yaxis="y1"
+    ))
+    fig.add_trace(go.Scatter(
+        x=df_stats["年月"], y=df_stats["ファンパワー"],
+        name="ファンパワー", line=dict(color='firebrick', width=3),
+        yaxis="y2"
+    ))
+    fig.update_layout(
+        xaxis=dict(title="対象月"),
+        yaxis=dict(title="ファン数（人）", side="left"),
+        yaxis2=dict(title="ファンパワー（Pt）", side="right", overlaying="y", showgrid=False),
+        legend=dict(x=0.01, y=0.99),
+        template="plotly_white", height=450, margin=dict(l=20, r=20, t=20, b=20)
+    )
+
+    # --- 統計テーブル ---
+    column_order = ["年月", "ファン名称", "ファン数", "ファンパワー"]
+    df_display_stats = df_stats.sort_values("年月", ascending=False)[column_order]
+
+    stats_td_style = "padding:10px; text-align:center;"
+    table_html = build_table_html(
+        df_display_stats,
+        [
+            {"key": "年月", "label": "年月", "th_style": "padding:12px; text-align:center;", "td_style": stats_td_style + " font-weight:bold;"},
+            {"key": "ファン名称", "label": "ファン名称", "th_style": "padding:12px; text-align:center;", "td_style": stats_td_style + " color:#2563eb;"},
+            {"key": "ファン数", "label": "ファン数", "th_style": "padding:12px; text-align:center;", "td_style": stats_td_style, "format": "comma"},
+            {"key": "ファンパワー", "label": "ファンパワー", "th_style": "padding:12px; text-align:center;", "td_style": stats_td_style, "format": "comma"},
+        ],
+        table_style="width:100%; border-collapse:collapse; font-size:14px;",
+        header_row_style="background-color:#f3f4f6; border-bottom:2px solid #e5e7eb;",
+        row_style="border-bottom:1px solid #f0f0f0;",
+    )
+
+    csv_stats = df_display_stats.to_csv(index=False, encoding="utf-8-sig").encode("utf-8-sig")
+    return (fig, table_html, csv_stats), failed
+
+
+def timed(name):
+    """直近の操作の計測（st.session_state.telemetry）に処理段階の所要時間を記録する"""
+    telemetry = st.session_state.get("telemetry")
+    return telemetry.stage(name) if telemetry is not None else nullcontext()
+
+
+def show_completeness(report):
+    """月ごとの完全性レポート（count と取得できたユニーク user_id 数の突き合わせ）を表示する"""
+    if not report:
+        return
+    problems = incomplete_months(report)
+    if problems:
+        st.warning(
+            f"取得件数が count と一致しない月・取得できなかった月があります: {', '.join(problems)}"
+            "（欠損範囲は再取得しても取得できなかったページです）"
+        )
+    with st.expander("🧾 取得データの完全性チェック", expanded=bool(problems)):
+        import pandas as pd
+        df_report = pd.DataFrame(report)
+
+        def highlight_status(val):
+            return "" if val == STATUS_COMPLETE else "background-color: #ffcccc; font-weight: bold;"
+
+        st.dataframe(df_report.style.map(highlight_status, subset=["状態"]),
+                     hide_index=True, use_container_width=True)
+
+
+def show_telemetry_panel(telemetry):
+    """通信・JSON解析・集計のどこに時間がかかったかを折りたたみ表示する"""
+    import pandas as pd
+    from fan_shared import get_shared_cache
+
+    summary = telemetry.summary()
+    with st.expander(f"⏱️ 取得・処理時間の計測（{telemetry.label}）", expanded=False):
+        col1, col2, col3, col4, col5 = st.columns(5)
+        col1.metric("リクエスト", f"{summary['requests']:,}")
+        col2.metric("再試行", f"{summary['retries']:,}")
+        col3.metric("取得できなかったページ", f"{summary['skipped_pages']:,}")
+        col4.metric("受信量", f"{summary['bytes'] / 1024 / 1024:.2f} MB")
+        col5.metric("レイテンシ p50 / p95", f"{summary['latency_p50_sec']:.2f} / {summary['latency_p95_sec']:.2f} 秒")
+        st.caption(
+            f"通信 延べ {summary['latency_total_sec']} 秒 / 送信枠待ち 延べ {summary['wait_total_sec']} 秒 / "
+            f"JSON解析 延べ {summary['parse_total_sec']} 秒 / 処理段階の合計 {summary['stage_total_sec']} 秒"
+            "（通信・待ち・解析は並列実行分を足し合わせた値）"
+        )
+        shared = get_shared_cache().stats()
+        st.caption(
+            f"全セッション共有キャッシュ: {shared['entries']} か月分 / "
+            f"{shared['bytes'] / 1024 / 1024:.1f} MB（上限 {shared['max_bytes'] / 1024 / 1024:.0f} MB） / "
+            f"ヒット {shared['hits']} 回 / 他セッションの取得に合流 {shared['coalesced']} 回 / "
+            f"追い出し {shared['evictions']} 回"
+        )
+
+        stage_rows = telemetry.stage_rows()
+        if stage_rows:
+            st.markdown("##### 処理段階ごとの所要時間")
+            st.dataframe(pd.DataFrame(stage_rows), hide_index=True, use_container_width=True)
+        if telemetry.requests:
+            st.markdown("##### 時間のかかったリクエスト（上位20件）")
+            slowest = pd.DataFrame(telemetry.requests).sort_values("latency_sec", ascending=False).head(20)
+            st.dataframe(slowest, hide_index=True, use_container_width=True)
+
+        col_json, col_csv = st.columns(2)
+        with col_json:
+            st.download_button("計測ログ(JSON)をダウンロード", data=telemetry.to_json().encode("utf-8"),
+                               file_name="fan_telemetry.json", mime="application/json", key="telemetry_json")
+        with col_csv:
+            st.download_button("計測ログ(CSV)をダウンロード", data=telemetry.to_csv().encode("utf-8-sig"),
+                               file_name="fan_telemetry.csv", mime="text/csv", key="telemetry_csv")
+
+
+def session_jobs():
+    """このセッション（URLの jobs パラメータで引き継いだ分を含む）のジョブ一覧"""
+    return get_job_manager().jobs(st.session_state.job_ids)
+
+
+def submit_job(kind, label, fn, **params):
+    """ジョブを投入し、再接続後も追跡できるようジョブIDをURLにも残す"""
+    job = get_job_manager().submit(kind, label, fn, **params)
+    st.session_state.job_ids.append(job.id)
+    st.query_params["jobs"] = ",".join(st.session_state.job_ids)
+    return job
+
+
+def job_matches(job, room_id, months):
+    return job.params["room_id"] == room_id and sorted(job.params["months"]) == sorted(months)
+
+
+def pick_up(job):
+    """完了したジョブの結果をセッションへ取り込むのは1回だけにする（初回のみ True）"""
+    if job.id in st.session_state.picked_jobs:
+        return False
+    st.session_state.picked_jobs.add(job.id)
+    return True
+
+
+def show_job(job):
+    """ジョブ1件の状態（実行中なら全体・月別の取得件数）を表示する"""
+    progress = job.progress()
+    st.markdown(f"**{job.label}** — {JOB_STATUS_LABELS[job.status]}（{job.elapsed():.0f} 秒）")
+    if job.status == JOB_FAILED:
+        st.error(f"エラー: {job.error}")
+        return
+    if job.finished:
+        if job.kind == "zip" and job.id != st.session_state.get("zip_job_id") and job.result["zip_bytes"]:
+            st.download_button("ZIPをダウンロード", data=job.result["zip_bytes"], file_name=job.result["file_name"],
+                               mime="application/zip", key=f"job_zip_{job.id}")
+        return
+    total = progress.get("total", 0)
+    done = progress.get("done", 0)
+    phase = progress.get("phase", JOB_STATUS_LABELS[job.status])
+    if total > 0:
+        st.progress(min(done / total, 1.0), text=f"{phase}: {done}/{total} 件 ({done / total * 100:.1f}%)")
+    else:
+        st.progress(0, text=phase)
+    counts = progress.get("counts", {})
+    retrieved = progress.get("retrieved", {})
+    for month, count in counts.items():
+        got = retrieved.get(month, 0)
+        col_text, col_bar = st.columns([3, 1])
+        with col_text:
+            st.markdown(f"<p style='font-size:14px; color:#374151;'>{month}: {got}/{count} 件取得中…</p>",
+                        unsafe_allow_html=True)
+        with col_bar:
+            st.progress(min(got / count, 1.0) if count > 0 else 1.0)
+
+
+def show_jobs_panel():
+    jobs = session_jobs()
+    if not jobs:
+        return
+    with st.expander("🧵 バックグラウンドジョブ", expanded=any(not job.finished for job in jobs)):
+        for job in reversed(jobs):
+            show_job(job)
+        if any(job.finished for job in jobs) and st.button("完了したジョブを一覧から消す", key="clear_jobs"):
+            finished = {job.id for job in jobs if job.finished}
+            st.session_state.job_ids = [i for i in st.session_state.job_ids if i not in finished]
+            st.query_params["jobs"] = ",".join(st.session_state.job_ids)
+            st.rerun()
+
+
+@st.fragment(run_every=JOB_POLL_SEC)
+def poll_jobs_panel():
+    """実行中のジョブがある間だけ一覧を定期的に描き直し、完了したら画面全体を再実行して結果を取り込む"""
+    show_jobs_panel()
+    if any(job.finished for job in get_job_manager().jobs(st.session_state.running_job_ids)):
+        st.rerun()
+
+
+def show_zip_result(job):
+    """完了したZIP作成ジョブの結果（完全性・件数・ダウンロード）を表示する"""
+    result = job.result
+    months = job.params["months"]
+    for month in result["failed_months"]:
+        if month in result["header_failed"]:
+            st.error(f"{month} の先頭ページを取得できませんでした（この月のCSVはZIPに含まれていません。時間をおいて再実行してください）")
+        else:
+            st.error(f"{month} の取得でエラー発生（再取得後も取得できないページがあります）")
+    changed_months = result["changed_months"]
+    if changed_months is not None:
+        st.caption(
+            f"差分更新: 再取得 {len(changed_months)} か月"
+            f"（{', '.join(sorted(changed_months)) or 'なし'}） / "
+            f"前回分を利用 {len(months) - len(changed_months)} か月"
+        )
+    show_completeness(result["completeness"])
+    fetch_stats = result["stats"]
+    st.caption(f"リクエスト {fetch_stats['requests']} 件 / 再試行 {fetch_stats['retries']} 回")
+
+    for idx, month in enumerate(months):
+        bg_color = "#f9fafb" if idx % 2 == 0 else "#e0f2fe"
+        st.markdown(
+            f"<div style='background-color:{bg_color}; padding:10px 15px; border-radius:10px; margin-bottom:6px;'>"
+            f"<p style='font-size:14px; color:#10b981; margin:0;'><b>{month} の取得完了 ({result['month_rows'].get(month, 0)} 件)</b></p>"
+            f"</div>",
+            unsafe_allow_html=True
+        )
+
+    if result["zip_bytes"] is None:
+        st.warning("該当データがありませんでした。")
+        return
+    st.markdown(
+        f"<div style='background-color:#f3f4f6; padding:10px; border-radius:10px; margin-bottom:10px;'>"
+        f"<h2 style='font-size:20px; color:#111827;'>マージファイル作成処理</h2>"
+        f"<p style='font-size:12px; color:#dc2626; font-weight:bold; margin-top:0;'>※退会ユーザーはマージデータには含まれません</p>"
+        f"<p style='font-size:14px; color:#10b981;'><b>マージCSV作成完了 ({result['merge_rows']} 件)</b></p>"
+        f"</div>",
+        unsafe_allow_html=True
+    )
+    st.markdown("<div style='margin-top:20px;'></div>", unsafe_allow_html=True)
+    st.download_button(
+        label="ZIPをダウンロード",
+        data=result["zip_bytes"],
+        file_name=result["file_name"],
+        mime="application/zip",
+        key="zip_download"
+    )
+
 
 if "authenticated" not in st.session_state:
     st.session_state.authenticated = False
 # 特殊コード認証フラグの初期化
 if "is_admin" not in st.session_state:
     st.session_state.is_admin = False
+# バックグラウンドジョブ：再接続で新しいセッションになっても、URLに残したジョブIDから引き継ぐ
+if "job_ids" not in st.session_state:
+    st.session_state.job_ids = [
+        job.id for job in get_job_manager().jobs(st.query_params.get("jobs", "").split(","))
+    ]
+    for job in get_job_manager().jobs(st.session_state.job_ids):
+        st.session_state[f"{job.kind}_job_id"] = job.id
+if "picked_jobs" not in st.session_state:
+    st.session_state.picked_jobs = set()
 
 # タイトル
 st.markdown(
@@ -40,54 +338,14 @@ st.markdown("---")
 
 # ▼▼ 認証ステップ ▼▼
 if not st.session_state.authenticated:
-    st.markdown("##### 🔑 認証コードを入力してください")
-    input_room_id = st.text_input(
-        "認証コードを入力してください:",
-        placeholder="",
-        type="password",
-        key="room_id_input"
-    )
-
-    if st.button("認証する"):
-        if input_room_id:
-            input_val = input_room_id.strip()
-            # 【追加】特殊コードの判定
-            if input_val == "mksp154851":
-                st.session_state.authenticated = True
-                st.session_state.is_admin = True
-                st.success("✅ 認証に成功しました。")
-                st.rerun()
-            
-            try:
-                response = requests.get(ROOM_LIST_URL, timeout=5)
-                response.raise_for_status()
-                room_df = pd.read_csv(io.StringIO(response.text), header=None)
-                valid_codes = set(str(x).strip() for x in room_df.iloc[:, 0].dropna())
-
-                if input_val in valid_codes:
-                    st.session_state.authenticated = True
-                    st.session_state.is_admin = False
-                    st.success("✅ 認証に成功しました。ツールを利用できます。")
-                    st.rerun()
-                else:
-                    st.error("❌ 認証コードが無効です。正しい認証コードを入力してください。")
-            except Exception as e:
-                st.error(f"認証リストを取得できませんでした: {e}")
-        else:
-            st.warning("認証コードを入力してください。")
+    show_auth_page()
     st.stop()
 
 # ルームID入力
 room_id = st.text_input("対象のルームID:", placeholder="例: 154851", value="")
 
-# 月の範囲を作成
-start_date = datetime(2023, 9, 1)
-current_date = datetime.now()
-month_labels = []
-tmp_date = current_date
-while tmp_date >= start_date:
-    month_labels.append(tmp_date.strftime("%Y%m"))
-    tmp_date -= relativedelta(months=1)
+# 月の範囲を作成（プロセス内で月ごとに1回だけ作る）
+month_labels = month_options(datetime.now().strftime("%Y%m"))
 
 # 月選択
 selected_months = st.multiselect("取得したい月を選択（複数選択可）:", options=month_labels, default=[])
@@ -106,8 +364,33 @@ if (room_id != st.session_state.prev_room_id) or (selected_months != st.session_
 
 st.markdown("<div style='margin-top:20px;'></div>", unsafe_allow_html=True)
 
+# 前回取得分と各月の件数を比較し、変化した月（と新しい月）だけを取り直す
+incremental_mode = st.checkbox(
+    "🔁 差分更新（前回取得分と件数を比較し、変化した月だけ再取得）",
+    value=False,
+    key="incremental_mode"
+)
+
+# 後続処理で pandas に読み直す用途向けに、型付きの列指向データも ZIP に同梱する
+parquet_mode = st.checkbox(
+    "🧱 Parquet も出力（ZIP内の parquet/ に月別パーティションとマージ集計を格納）",
+    value=False,
+    key="parquet_mode",
+    disabled=not fan_parquet.available(),
+    help=None if fan_parquet.available() else "pyarrow がインストールされていないため利用できません。"
+)
+
+# ダウンロードサイズを抑えるため、月別CSVは取得の終わった月から並列に圧縮する
+zip_compression = st.selectbox(
+    "🗜️ ZIPの圧縮形式",
+    options=list(COMPRESSION_CODECS),
+    index=list(COMPRESSION_CODECS).index(DEFAULT_COMPRESSION),
+    format_func=lambda codec: COMPRESSION_LABELS.get(codec, codec),
+    key="zip_compression"
+)
+
 # 処理を完全に分けるため、カラムでボタンを配置
-col_btn1, col_btn2 = st.columns([1, 1])
+col_btn1, col_btn2, col_btn3 = st.columns([1, 1, 1])
 
 with col_btn1:
     start_button = st.button("データ取得 & ZIP作成")
@@ -115,6 +398,24 @@ with col_btn1:
 with col_btn2:
     stats_button = st.button("📊 ファン統計（推移）を表示")
 
+with col_btn3:
+    # 締め済みの月は永続キャッシュされるため、明示的に破棄する手段を用意する
+    if st.button("🗑️ このルームのキャッシュを削除"):
+        if room_id:
+            from fan_shared import get_shared_cache
+            deleted = fan_cache.invalidate(room_id)
+            get_shared_cache().invalidate(room_id)
+            build_stats_view.clear()
+            st.success(f"キャッシュを削除しました（{deleted} か月分）")
+        else:
+            st.warning("ルームIDを入力してください。")
+
+# 実行中・完了済みのジョブ（実行中がある間は定期的に描き直す）
+st.session_state.running_job_ids = [job.id for job in session_jobs() if not job.finished]
+if st.session_state.running_job_ids:
+    poll_jobs_panel()
+else:
+    show_jobs_panel()
 
 
 # ---------------------------------------------------------
@@ -132,181 +433,108 @@ if stats_button:
 
 # 「統計を表示」フラグがオンの間は、ずっと表示され続ける
 if st.session_state.show_stats_view:
+    # グラフ・分析の部品は統計を開いたときに初めて読み込む
+    import plotly.graph_objects as go
+    from fan_analysis import fan_flow, level_change_alerts, retention_cohorts
+    from fan_tasks import detail_task
+
     if not room_id or not selected_months:
         st.warning("ルームIDの入力と月の選択を必ず行ってください。")
     else:
         try:
-            df_room_list = pd.read_csv(ROOM_LIST_URL, header=None)
-            auth_ids = df_room_list.iloc[:, 0].astype(str).tolist()
-            
-            if st.session_state.is_admin or (room_id in auth_ids):
-                st.markdown("### 📈 ファン数・ファンパワーの推移")
-                stats_list = []
-                all_fans_data_for_analysis = [] 
-                
-                for m in sorted(selected_months): 
-                    url = f"https://www.showroom-live.com/api/active_fan/users?room_id={room_id}&ym={m}"
-                    resp = requests.get(url)
-                    if resp.status_code == 200:
-                        data = resp.json()
-                        stats_list.append({
-                            "年月": m,
-                            "ファン数": data.get("total_user_count", 0),
-                            "ファンパワー": data.get("fan_power", 0),
-                            "ファン名称": data.get("fan_name", "-")
-                        })
-                        users = data.get("users", [])
-                        # --- 【修正点1】 各ユーザーデータに年月(ym)を注入してエラーを回避 ---
-                        for u in users:
-                            u['ym'] = m
-                        all_fans_data_for_analysis.extend(users)
-                
-                if stats_list:
-                    df_stats = pd.DataFrame(stats_list)
-
-                    # --- グラフ作成（Plotly 2軸） ---
-                    fig = go.Figure()
-                    fig.add_trace(go.Bar(
-                        x=df_stats["年月"], y=df_stats["ファン数"],
-                        name="ファン数", marker_color='rgba(55, 128, 191, 0.7)',
-                        yaxis="y1"
-                    ))
-                    fig.add_trace(go.Scatter(
-                        x=df_stats["年月"], y=df_stats["ファンパワー"],
-                        name="ファンパワー", line=dict(color='firebrick', width=3),
-                        yaxis="y2"
-                    ))
-                    fig.update_layout(
-                        xaxis=dict(title="対象月"),
-                        yaxis=dict(title="ファン数（人）", side="left"),
-                        yaxis2=dict(title="ファンパワー（Pt）", side="right", overlaying="y", showgrid=False),
-                        legend=dict(x=0.01, y=0.99),
-                        template="plotly_white", height=450, margin=dict(l=20, r=20, t=20, b=20)
+            if st.session_state.is_admin or (room_id in get_room_index()):
+                col_stats_head, col_stats_refresh = st.columns([4, 1])
+                with col_stats_head:
+                    st.markdown("### 📈 ファン数・ファンパワーの推移")
+                with col_stats_refresh:
+                    # 当月分はTTL内でも明示的に取り直せるようにする（締め済みの月は不変）
+                    if st.button("🔄 最新に更新", key="stats_refresh_btn"):
+                        from fan_shared import get_shared_cache
+                        refresh_months = [m for m in selected_months if not fan_cache.is_closed_month(m)]
+                        if refresh_months:
+                            fan_cache.invalidate(room_id, refresh_months)
+                            get_shared_cache().invalidate(room_id, refresh_months)
+                        # 他のルーム・月の組み合わせのメモは残す
+                        build_stats_view.clear(room_id, tuple(sorted(selected_months)))
+
+                # 取得済みの月は共有キャッシュ・ディスクキャッシュ経由で詳細分析・ZIP作成でも使い回す
+                stats_view, header_failed = build_stats_view(room_id, tuple(sorted(selected_months)))
+                if header_failed:
+                    # 一時的な失敗を TTL の間残さないよう、この組み合わせのメモだけを消して次回取り直す
+                    build_stats_view.clear(room_id, tuple(sorted(selected_months)))
+                    st.warning(
+                        f"先頭ページを取得できなかった月があります: {', '.join(header_failed)}"
+                        "（取得できた月だけを表示しています。再表示すると取り直します）"
                     )
+                if stats_view is not None:
+                    fig, table_html, csv_stats = stats_view
                     st.plotly_chart(fig, use_container_width=True)
 
                     # --- 統計テーブル表示 ---
                     st.markdown("#### 📋 統計データ一覧")
-                    column_order = ["年月", "ファン名称", "ファン数", "ファンパワー"]
-                    df_display_stats = df_stats.sort_values("年月", ascending=False)[column_order]
-                    
-                    table_html = "<table style='width:100%; border-collapse:collapse; font-size:14px;'><thead><tr style='background-color:#f3f4f6; border-bottom:2px solid #e5e7eb;'><th style='padding:12px; text-align:center;'>年月</th><th style='padding:12px; text-align:center;'>ファン名称</th><th style='padding:12px; text-align:center;'>ファン数</th><th style='padding:12px; text-align:center;'>ファンパワー</th></tr></thead><tbody>"
-                    for idx, row in df_display_stats.iterrows():
-                        table_html += f"<tr style='border-bottom:1px solid #f0f0f0;'><td style='padding:10px; text-align:center; font-weight:bold;'>{row['年月']}</td><td style='padding:10px; text-align:center; color:#2563eb;'>{row['ファン名称']}</td><td style='padding:10px; text-align:center;'>{row['ファン数']:,}</td><td style='padding:10px; text-align:center;'>{row['ファンパワー']:,}</td></tr>"
-                    table_html += "</tbody></table>"
                     st.markdown(table_html, unsafe_allow_html=True)
 
-                    csv_stats = df_display_stats.to_csv(index=False, encoding="utf-8-sig").encode("utf-8-sig")
-                    st.download_button(label="統計CSVをダウンロード", data=csv_stats, file_name=f"fan_stats_{room_id}.csv", mime="text/csv")
+                    col_csv_stats, col_csv_cohort = st.columns(2)
+                    with col_csv_stats:
+                        st.download_button(label="統計CSVをダウンロード", data=csv_stats, file_name=f"fan_stats_{room_id}.csv", mime="text/csv")
+                    # 定着・離脱のCSVは詳細分析の完了後に下の分析セクションから書き込む
 
 
 
                     # --- 追加分析セクション ---
                     st.markdown("---")
 
-                    if st.button("🔍 さらに詳細分析する", key="detail_analysis_btn"):
-                        # 全体の進捗管理用
-                        total_months = len(selected_months)
-                        progress_bar = st.progress(0) # 進捗バー本体
-                        status_text = st.empty()      # テキスト表示用
-                        
-                        full_analysis_data = []
-                        
-                        # 各月の処理
-                        for i, m in enumerate(sorted(selected_months)):
-                            # 月ごとのステータス更新
-                            current_overall_progress = i / total_months
-                            status_text.info(f"⏳ データ取得中: {m} ({i+1}/{total_months}ヶ月目)")
-                            
-                            try:
-                                init_url = f"https://www.showroom-live.com/api/active_fan/users?room_id={room_id}&ym={m}"
-                                init_resp = requests.get(init_url)
-                                init_data = init_resp.json()
-                                count = init_data.get("count", 0) 
-                            except:
-                                count = 0
-
-                            retrieved = 0
-                            per_page = 50 
-
-                            while retrieved < count:
-                                # 月内の進捗を計算してバーに反映 (微細な動き)
-                                if count > 0:
-                                    sub_progress = (retrieved / count) * (1 / total_months)
-                                    progress_bar.progress(min(current_overall_progress + sub_progress, 1.0))
-                                
-                                url = f"https://www.showroom-live.com/api/active_fan/users?room_id={room_id}&ym={m}&offset={retrieved}&limit={per_page}"
-                                try:
-                                    resp = requests.get(url)
-                                    if resp.status_code != 200:
-                                        time.sleep(1.0)
-                                        retrieved += per_page 
-                                        continue
-                                        
-                                    data = resp.json()
-                                    users = data.get("users", [])
-                                    
-                                    if not users:
-                                        retrieved += per_page
-                                        continue
-                                    
-                                    for u in users:
-                                        u['ym'] = m
-                                        full_analysis_data.append(u)
-                                    
-                                    retrieved += len(users)
-                                    time.sleep(0.05)
-                                    
-                                except Exception:
-                                    retrieved += per_page
-                                    continue
-                            
-                            # その月が終わった時点の進捗に更新
-                            progress_bar.progress((i + 1) / total_months)
-
-                        status_text.success("✅ 全データの取得が完了しました！")
-                        time.sleep(0.5) # 完了を視認させるための僅かな待ち
-                        
-                        # セッションに保存して分析へ
-                        st.session_state.full_fans_data = full_analysis_data
-                        st.session_state.show_detail_analysis = True
+                    # 全ページの取得はバックグラウンドジョブで行い、進捗は上のジョブ一覧に表示する
+                    detail_job = get_job_manager().get(st.session_state.get("detail_job_id"))
+                    if detail_job is not None and not job_matches(detail_job, room_id, selected_months):
+                        detail_job = None
+                    detail_running = detail_job is not None and not detail_job.finished
+
+                    if st.button("🔍 さらに詳細分析する", key="detail_analysis_btn", disabled=detail_running):
+                        job = submit_job(
+                            "detail", f"詳細分析 {room_id}（{len(selected_months)}か月）", detail_task,
+                            room_id=room_id, months=sorted(selected_months), incremental=incremental_mode
+                        )
+                        st.session_state.detail_job_id = job.id
                         st.rerun()
 
+                    if detail_running:
+                        st.info(f"⏳ データ取得中: {len(selected_months)}ヶ月分（画面を操作・再読み込みしても取得は続きます）")
+                    elif detail_job is not None and detail_job.status == JOB_FAILED:
+                        st.error(f"詳細分析用のデータ取得に失敗しました: {detail_job.error}")
+                    elif detail_job is not None:
+                        result = detail_job.result
+                        if pick_up(detail_job):
+                            # ユーザー×月のレベル行列はジョブ側で一度だけ作り、セッションに保存して分析へ
+                            st.session_state.fan_matrix = result["fan_matrix"]
+                            st.session_state.fan_completeness = result["completeness"]
+                            st.session_state.telemetry = result["telemetry"]
+                            st.session_state.show_detail_analysis = True
+                        if st.session_state.get("show_detail_analysis", False):
+                            if result["header_failed"]:
+                                st.error(
+                                    f"{', '.join(result['header_failed'])} の先頭ページを取得できませんでした"
+                                    "（この月は分析に含まれていません）"
+                                )
+                            fetch_stats = result["stats"]
+                            st.success(
+                                f"✅ 全データの取得が完了しました！（リクエスト {fetch_stats['requests']} 件 / "
+                                f"再試行 {fetch_stats['retries']} 回 / 取得失敗 {result['failed_pages']} ページ）"
+                            )
+
                     # 分析表示セクション
                     if st.session_state.get('show_detail_analysis', False):
                         st.markdown("### 🧬 ファンデータ詳細分析")
+                        show_completeness(st.session_state.get("fan_completeness"))
                         
-                        # セッション内の全量データ(full_fans_data)を使用して分析
-                        if "full_fans_data" in st.session_state and st.session_state.full_fans_data:
-                            full_df = pd.DataFrame(st.session_state.full_fans_data)
-
+                        # 取得完了時に作成したレベル行列(fan_matrix)から各分析を導出する
+                        fan_matrix = st.session_state.get("fan_matrix")
+                        if fan_matrix is not None and len(fan_matrix) > 0:
                             # --- 🏆 合算ランキング表示 ---
                             st.markdown("#### 🏆 合算ランキング <span style='font-size: 0.6em; color: gray;'>(選択月累計)</span>", unsafe_allow_html=True)
 
-                            # 修正：aggの中でlambdaを使用して「レベル10以上の月数」をカウントする
-
-                            analysis_df = full_df.groupby('user_id').agg({
-                                'level': [
-                                    ('レベル合計値', 'sum'),
-                                    ('ファン回数', lambda x: (x >= 10).sum())
-                                ],
-                                'user_name': 'first'
-                            }).reset_index()
-
-
-                            # マルチカラムをフラット化
-                            analysis_df.columns = ['user_id', 'レベル合計値', 'ファン回数', 'ユーザー名']
-
-                            analysis_df['平均レベル'] = analysis_df['レベル合計値'] / len(selected_months)
-                            analysis_df['平均レベル'] = analysis_df['平均レベル'].round(1)
-
-                            # 以降の処理（フィルタ・順位付け）
-                            analysis_df = analysis_df[analysis_df['レベル合計値'] >= 0]
-                            analysis_df['順位'] = analysis_df['レベル合計値'].rank(method='min', ascending=False).astype(int)
-                            analysis_df = analysis_df.sort_values('順位', ascending=True).reset_index(drop=True)
-
-                            # 順位引き出し用の辞書作成
-                            rank_map = analysis_df.set_index('user_id')['順位'].to_dict()
+                            with timed("合算ランキング"):
+                                analysis_df = fan_matrix.ranking(len(selected_months))
 
                             # --- 🏆 合算ランキング（DataFrame表示） ---
 
@@ -360,179 +588,169 @@ if st.session_state.show_stats_view:
                             with col_head2:
                                 threshold = st.number_input("検知しきい値 (±)", min_value=1, value=7, step=1)
 
-                            if 'ym' not in full_df.columns:
-                                st.error("エラー：データ内に年月情報が見つかりません。")
+                            sorted_yms = fan_matrix.months
+                            if len(sorted_yms) < 2:
+                                st.info("レベルの変動を分析するには、2ヶ月以上のデータを選択してください。")
                             else:
-                                sorted_yms = sorted(list(full_df['ym'].unique()))
-                                if len(sorted_yms) < 2:
-                                    st.info("レベルの変動を分析するには、2ヶ月以上のデータを選択してください。")
-                                else:
-                                    alert_list = []
-                                    
-                                    # 全ユーザーIDを網羅
-                                    for uid, group in full_df.groupby('user_id'):
-                                        u_name = group['user_name'].iloc[-1]
-                                        lv_map = group.set_index('ym')['level'].to_dict()
-                                        u_rank = rank_map.get(uid, 999999) 
-                                        
-                                        user_temp_alerts = []
-                                        
-                                        # 【修正の肝】レコードの有無に関わらず、選択期間の「全月」を走査
-                                        for i in range(len(sorted_yms) - 1):
-                                            prev_m, curr_m = sorted_yms[i], sorted_yms[i+1]
-                                            
-                                            # レコードがない月は 0 として取得
-                                            prev_lv = lv_map.get(prev_m, 0)
-                                            curr_lv = lv_map.get(curr_m, 0)
-                                            
-                                            # 両方0（ずっと活動なし）なら無視
-                                            if prev_lv == 0 and curr_lv == 0:
-                                                continue
-                                                
-                                            diff = curr_lv - prev_lv
-                                            
-                                            # 絶対値でしきい値を判定（これで 5→8 の +3 も拾えるようになる）
-                                            if abs(diff) >= threshold:
-                                                kind = "🚀大幅上昇" if diff > 0 else "🔻大幅下落"
-                                                user_temp_alerts.append({
-                                                    "順位": u_rank if u_rank != 999999 else 999999,
-                                                    "ユーザー名": u_name,
-                                                    "種別": kind,
-                                                    "前月": prev_m,
-                                                    "前月Lv": prev_lv,
-                                                    "当月": curr_m,
-                                                    "当月Lv": curr_lv,
-                                                    "変動": diff
-                                                })
-                                        
-                                        if user_temp_alerts:
-                                            # 月が新しい順に並べ替え
-                                            user_temp_alerts.sort(
-                                                key=lambda x: -int(str(x['前月']).replace('/',''))
-                                            )
-                                            alert_list.append({
-                                                "rank": u_rank,
-                                                "alerts": user_temp_alerts
-                                            })
-                                    
-                                    if alert_list:
-                                        rows = []
-
-                                        for user_block in alert_list:
-                                            for a in user_block["alerts"]:
-                                                rows.append({
-                                                    "順位": a["順位"],
-                                                    "ユーザー名": a.get("ユーザー名", "不明"),
-                                                    "種別": a["種別"],
-                                                    "前月": a["前月"],
-                                                    "前月Lv": a["前月Lv"],
-                                                    "当月": a["当月"],
-                                                    "当月Lv": a["当月Lv"],
-                                                    "変動": a["変動"]
-                                                })
-
-                                        alert_df = pd.DataFrame(rows)
-
-                                        alert_df["_rank"] = alert_df["順位"]
-                                        alert_df["_month"] = alert_df["当月"].str.replace("/", "").astype(int)
-
-                                        alert_df = alert_df.sort_values(
-                                            by=["_rank", "_month"],
-                                            ascending=[True, False]
-                                        ).drop(columns=["_rank", "_month"])
-
-                                        def highlight_kind(val):
-                                            if "上昇" in str(val):
-                                                return "background-color: #99ff99; font-weight: bold;"
-                                            if "下落" in str(val):
-                                                return "background-color: #ffcccc; font-weight: bold;"
-                                            return ""
-
-                                        # 表示用に順位を整形（数値→表示だけ）
-                                        display_df = alert_df.copy()
-                                        display_df["順位"] = display_df["順位"].apply(lambda x: x if x != 999999 else "-")
-
-                                        # 【追加】前月・当月を数値化（右寄せ用）
-                                        display_df["前月_num"] = display_df["前月"].str.replace("/", "").astype(int)
-                                        display_df["当月_num"] = display_df["当月"].str.replace("/", "").astype(int)
-
-                                        # 元の文字列列を削除して置き換え
-                                        display_df = display_df.drop(columns=["前月", "当月"])
-                                        display_df = display_df.rename(columns={
-                                            "前月_num": "前月",
-                                            "当月_num": "当月"
-                                        })
-
-                                        display_df = display_df[
-                                            [
+                                # ユーザー×月のレベル行列から前月比を一括計算する
+                                with timed("レベル急変動アラート"):
+                                    alert_df = level_change_alerts(fan_matrix, threshold)
+
+                                if not alert_df.empty:
+                                    def highlight_kind(val):
+                                        if "上昇" in str(val):
+                                            return "background-color: #99ff99; font-weight: bold;"
+                                        if "下落" in str(val):
+                                            return "background-color: #ffcccc; font-weight: bold;"
+                                        return ""
+
+                                    # 表示用に順位を整形（数値→表示だけ）
+                                    display_df = alert_df.copy()
+                                    display_df["順位"] = display_df["順位"].apply(lambda x: x if x != 999999 else "-")
+
+                                    # 【追加】前月・当月を数値化（右寄せ用）
+                                    display_df["前月_num"] = display_df["前月"].str.replace("/", "").astype(int)
+                                    display_df["当月_num"] = display_df["当月"].str.replace("/", "").astype(int)
+
+                                    # 元の文字列列を削除して置き換え
+                                    display_df = display_df.drop(columns=["前月", "当月"])
+                                    display_df = display_df.rename(columns={
+                                        "前月_num": "前月",
+                                        "当月_num": "当月"
+                                    })
+
+                                    display_df = display_df[
+                                        [
+                                            "順位",
+                                            "ユーザー名",
+                                            "種別",
+                                            "前月",
+                                            "前月Lv",
+                                            "当月",
+                                            "当月Lv",
+                                            "変動",
+                                        ]
+                                    ]
+
+                                    st.dataframe(
+                                        display_df.style.map(highlight_kind, subset=["種別"]),
+                                        use_container_width=True,
+                                        height=500,
+                                        hide_index=True,
+                                        column_config={
+                                            "順位": st.column_config.NumberColumn(
                                                 "順位",
+                                                width="small",
+                                                format="%d 位"
+                                            ),
+                                            "ユーザー名": st.column_config.TextColumn(
                                                 "ユーザー名",
+                                                width="large"
+                                            ),
+                                            "種別": st.column_config.TextColumn(
                                                 "種別",
+                                                width="medium"
+                                            ),
+                                            "前月": st.column_config.NumberColumn(
                                                 "前月",
+                                                width="small",
+                                                format="%d"
+                                            ),
+                                            "前月Lv": st.column_config.NumberColumn(
                                                 "前月Lv",
+                                                width="small"
+                                            ),
+                                            "当月": st.column_config.NumberColumn(
                                                 "当月",
+                                                width="small",
+                                                format="%d"
+                                            ),
+                                            "当月Lv": st.column_config.NumberColumn(
                                                 "当月Lv",
+                                                width="small"
+                                            ),
+                                            "変動": st.column_config.NumberColumn(
                                                 "変動",
-                                            ]
-                                        ]
+                                                width="small",
+                                                format="%+d"
+                                            ),
+                                        }
+                                    )
+                                else:
+                                    st.info(f"条件（レベル変動±{threshold}以上）に該当するユーザーはいませんでした。")
+
 
-                                        st.dataframe(
-                                            display_df.style.map(highlight_kind, subset=["種別"]),
-                                            use_container_width=True,
-                                            height=500,
-                                            hide_index=True,
-                                            column_config={
-                                                "順位": st.column_config.NumberColumn(
-                                                    "順位",
-                                                    width="small",
-                                                    format="%d 位"
-                                                ),
-                                                "ユーザー名": st.column_config.TextColumn(
-                                                    "ユーザー名",
-                                                    width="large"
-                                                ),
-                                                "種別": st.column_config.TextColumn(
-                                                    "種別",
-                                                    width="medium"
-                                                ),
-                                                "前月": st.column_config.NumberColumn(
-                                                    "前月",
-                                                    width="small",
-                                                    format="%d"
-                                                ),
-                                                "前月Lv": st.column_config.NumberColumn(
-                                                    "前月Lv",
-                                                    width="small"
-                                                ),
-                                                "当月": st.column_config.NumberColumn(
-                                                    "当月",
-                                                    width="small",
-                                                    format="%d"
-                                                ),
-                                                "当月Lv": st.column_config.NumberColumn(
-                                                    "当月Lv",
-                                                    width="small"
-                                                ),
-                                                "変動": st.column_config.NumberColumn(
-                                                    "変動",
-                                                    width="small",
-                                                    format="%+d"
-                                                ),
-                                            }
-                                        )
-                                    else:
-                                        st.info(f"条件（レベル変動±{threshold}以上）に該当するユーザーはいませんでした。")
+                            # --- 🔁 ファンの定着・離脱（コホート） ---
+                            st.write("---")
+                            st.markdown("#### 🔁 ファンの定着・離脱")
+                            if len(fan_matrix.months) < 2:
+                                st.info("定着・離脱を分析するには、2ヶ月以上のデータを選択してください。")
+                            else:
+                                # ユーザー×月の在籍（レベル1以上）行列の列演算だけで集計する
+                                with timed("定着・離脱（コホート）"):
+                                    flow_df = fan_flow(fan_matrix)
+                                    cohort_df = retention_cohorts(fan_matrix)
+
+                                with col_csv_cohort:
+                                    st.download_button(
+                                        label="定着・離脱CSVをダウンロード",
+                                        data=flow_df.to_csv(index=False, encoding="utf-8-sig").encode("utf-8-sig"),
+                                        file_name=f"fan_flow_{room_id}.csv", mime="text/csv", key="flow_csv"
+                                    )
+                                    st.download_button(
+                                        label="コホート定着率CSVをダウンロード",
+                                        data=cohort_df.to_csv(index=False, encoding="utf-8-sig").encode("utf-8-sig"),
+                                        file_name=f"fan_cohort_{room_id}.csv", mime="text/csv", key="cohort_csv"
+                                    )
 
+                                flow_fig = go.Figure()
+                                for col_name, color in [("継続", "rgba(55, 128, 191, 0.8)"),
+                                                        ("復帰", "rgba(16, 185, 129, 0.8)"),
+                                                        ("新規", "rgba(250, 204, 21, 0.8)")]:
+                                    flow_fig.add_trace(go.Bar(x=flow_df["年月"], y=flow_df[col_name], name=col_name,
+                                                              marker_color=color, yaxis="y1"))
+                                flow_fig.add_trace(go.Bar(x=flow_df["年月"], y=-flow_df["離脱"], name="離脱",
+                                                          marker_color="rgba(220, 38, 38, 0.7)", yaxis="y1",
+                                                          customdata=flow_df["離脱"],
+                                                          hovertemplate="離脱: %{customdata}<extra></extra>"))
+                                flow_fig.add_trace(go.Scatter(x=flow_df["年月"], y=flow_df["定着率(%)"], name="定着率(%)",
+                                                              line=dict(color="firebrick", width=3), yaxis="y2"))
+                                flow_fig.update_layout(
+                                    barmode="relative",
+                                    xaxis=dict(title="対象月", type="category"),
+                                    yaxis=dict(title="人数（離脱はマイナス）", side="left"),
+                                    yaxis2=dict(title="定着率（%）", side="right", overlaying="y", showgrid=False,
+                                                range=[0, 100]),
+                                    legend=dict(orientation="h", y=1.1),
+                                    template="plotly_white", height=420, margin=dict(l=20, r=20, t=40, b=20)
+                                )
+                                st.plotly_chart(flow_fig, use_container_width=True)
+                                st.dataframe(flow_df, use_container_width=True, hide_index=True)
+
+                                st.markdown("##### 📉 初回月別の定着率（コホート）")
+                                curve_fig = go.Figure()
+                                for first_month, cohort in cohort_df.groupby("初回月", sort=True):
+                                    curve_fig.add_trace(go.Scatter(
+                                        x=cohort["経過月数"], y=cohort["定着率(%)"], mode="lines+markers",
+                                        name=f"{first_month}（{cohort['コホート人数'].iloc[0]:,}人）"
+                                    ))
+                                curve_fig.update_layout(
+                                    xaxis=dict(title="初回月からの経過（選択月の数）", dtick=1),
+                                    yaxis=dict(title="定着率（%）", range=[0, 105]),
+                                    template="plotly_white", height=420, margin=dict(l=20, r=20, t=20, b=20)
+                                )
+                                st.plotly_chart(curve_fig, use_container_width=True)
 
                             # --- 🔍 特定ユーザーの詳細分析 ---
                             st.write("---")
                             st.markdown("#### 🔍 特定ユーザーの詳細推移")
 
                             # 1. ユーザー選択リスト作成（表示上だけ整数にする）
-                            user_options = {
-                                str(row['user_id']): f"{int(row['順位'])}位：{row['ユーザー名']} ({int(row['user_id'])})" 
-                                for _, row in analysis_df.iterrows()
-                            }
+                            user_options = dict(zip(
+                                analysis_df['user_id'].astype(str),
+                                analysis_df['順位'].astype(str) + "位：" + analysis_df['ユーザー名'].astype(str)
+                                + " (" + analysis_df['user_id'].astype(str) + ")"
+                            ))
 
                             target_uid = st.selectbox(
                                 "分析するユーザーを選択", 
@@ -542,21 +760,10 @@ if st.session_state.show_stats_view:
                             )
 
                             if target_uid:
-                                # 2. 【重要】比較対象の型を合わせる（target_uidは文字列、full_df['user_id']も文字列にキャストして比較）
-                                u_data_existing = full_df[full_df['user_id'].astype(str) == str(target_uid)].copy()
-                                
-                                # 3. 全期間(sorted_yms)の器を作成し、データがない月をレベル0で埋める
-                                plot_data = []
-                                for ym in sorted_yms:
-                                    row = u_data_existing[u_data_existing['ym'] == ym]
-                                    if not row.empty:
-                                        # 取得したレベルを数値として保持
-                                        plot_data.append({"ym": ym, "level": int(row['level'].values[0])})
-                                    else:
-                                        plot_data.append({"ym": ym, "level": 0})
-                                
+                                # 2. レベル行列の1行を引くだけで全期間（データのない月は0）の推移が得られる
+                                u_full_display_df = fan_matrix.user_history(target_uid)
+
                                 # グラフ用(昇順)とテーブル用(降順)のDFを作成
-                                u_full_display_df = pd.DataFrame(plot_data)
                                 u_data_graph = u_full_display_df.sort_values('ym')
                                 u_data_table = u_full_display_df.sort_values('ym', ascending=False)
                                 
@@ -625,7 +832,7 @@ if st.session_state.show_stats_view:
 
 
 # ---------------------------------------------------------
-# 既存機能：データ取得 & ZIP作成セクション（変更なし）
+# 既存機能：データ取得 & ZIP作成セクション
 # ---------------------------------------------------------
 if start_button:
     if not room_id or not selected_months:
@@ -633,10 +840,8 @@ if start_button:
     else:
         is_authenticated = False
         try:
-            df_room_list = pd.read_csv(ROOM_LIST_URL, header=None)
-            auth_ids = df_room_list.iloc[:, 0].astype(str).tolist()
             # 【修正】管理者フラグがある場合はリストチェックをパス
-            if st.session_state.is_admin or (room_id in auth_ids):
+            if st.session_state.is_admin or (room_id in get_room_index()):
                 is_authenticated = True
             else:
                 st.error("指定されたルームIDは認証されていません。")
@@ -644,181 +849,161 @@ if start_button:
             st.error(f"認証リストの取得に失敗しました。管理者にご確認ください。 (Error: {e})")
 
         if is_authenticated:
-            st.info(f"{len(selected_months)}か月分のデータを取得します。")
-            monthly_counts = {}
-            overall_progress = st.progress(0)
-            overall_text = st.empty()
-            processed_fans = 0
-            total_fans_overall = 0
-
-            zip_buffer = BytesIO()
-            zip_file = ZipFile(zip_buffer, "w")
-
-            for month in selected_months:
-                url = f"https://www.showroom-live.com/api/active_fan/users?room_id={room_id}&ym={month}"
-                resp = requests.get(url)
-                if resp.status_code == 200:
-                    data = resp.json()
-                    monthly_counts[month] = data.get("count", 0)
-                    total_fans_overall += monthly_counts[month]
-                else:
-                    monthly_counts[month] = 0
-
-            all_fans_data = []
-            orig_order_counter = 0
-            for idx, month in enumerate(selected_months):
-                bg_color = "#f9fafb" if idx % 2 == 0 else "#e0f2fe"
-                st.markdown(
-                    f"<div style='background-color:{bg_color}; padding:15px; border-radius:10px; margin-bottom:10px;'>"
-                    f"<h2 style='font-size:20px; color:#111827;'>{month} の処理</h2>"
-                    f"</div>",
-                    unsafe_allow_html=True
+            running = [
+                job for job in session_jobs()
+                if job.kind == "zip" and not job.finished and job_matches(job, room_id, selected_months)
+            ]
+            if running:
+                st.info("同じルーム・月のZIP作成を実行中です。完了までお待ちください。")
+            else:
+                # 取得・CSV書き込み・ZIP作成はバックグラウンドジョブで行い、画面は進捗を表示するだけにする
+                from fan_tasks import zip_task
+                job = submit_job(
+                    "zip", f"ZIP作成 {room_id}（{len(selected_months)}か月）", zip_task,
+                    room_id=room_id, months=list(selected_months), incremental=incremental_mode,
+                    parquet=parquet_mode, top_n=MERGE_TOP_N, compression=zip_compression
                 )
+                st.session_state.zip_job_id = job.id
+                st.rerun()
 
-                col_text, col_bar = st.columns([3, 1])
-                with col_text:
-                    month_text = st.empty()
-                with col_bar:
-                    month_progress = st.progress(0)
-
-                fans_data = []
-                count = monthly_counts[month]
-                per_page = 50
-                retrieved = 0
-
-                while retrieved < count:
-                    url = f"https://www.showroom-live.com/api/active_fan/users?room_id={room_id}&ym={month}&offset={retrieved}&limit={per_page}"
-                    resp = requests.get(url)
-                    if resp.status_code != 200:
-                        st.error(f"{month} の取得でエラー発生")
-                        break
-                    data = resp.json()
-                    users = data.get("users", [])
-                    for u in users:
-                        u['orig_order'] = orig_order_counter
-                        orig_order_counter += 1
-                    fans_data.extend(users)
-                    all_fans_data.extend(users)
-                    retrieved += len(users)
-
-                    if count > 0:
-                        month_progress.progress(min(retrieved / count, 1.0))
-                        month_text.markdown(
-                            f"<p style='font-size:14px; color:#374151;'>{retrieved}/{count} 件取得中…</p>",
-                            unsafe_allow_html=True
-                        )
-                    processed_fans += len(users)
-                    if total_fans_overall > 0:
-                        overall_progress.progress(min(processed_fans / total_fans_overall, 1.0))
-                        overall_text.markdown(
-                            f"<p style='font-size:14px; color:#1f2937;'>"
-                            f"全体進捗: {processed_fans}/{total_fans_overall} 件 ({processed_fans/total_fans_overall*100:.1f}%)"
-                            f"</p>",
-                            unsafe_allow_html=True
-                        )
-                    time.sleep(0.05)
+zip_job = get_job_manager().get(st.session_state.get("zip_job_id"))
+if zip_job is not None and zip_job.status == JOB_DONE:
+    if pick_up(zip_job):
+        result = zip_job.result
+        st.session_state.telemetry = result["telemetry"]
+        # ページ切り替え（再実行）後も表示できるようセッションに残す
+        if result["merge_top"] is not None and not result["merge_top"].empty:
+            st.session_state.merge_top = {
+                "room_id": zip_job.params["room_id"],
+                "months": list(zip_job.params["months"]),
+                "df": result["merge_top"],
+            }
+        else:
+            st.session_state.merge_top = None
+    if job_matches(zip_job, room_id, selected_months):
+        show_zip_result(zip_job)
+elif zip_job is not None and zip_job.status == JOB_FAILED and job_matches(zip_job, room_id, selected_months):
+    st.error(f"ZIP作成に失敗しました: {zip_job.error}")
 
-                if fans_data:
-                    df = pd.DataFrame(fans_data)
-                    df = df[['avatar_id','level','title_id','user_id','user_name']]
-                    csv_bytes = df.to_csv(index=False, encoding="utf-8-sig").encode("utf-8-sig")
-                    zip_file.writestr(f"active_fans_{room_id}_{month}.csv", csv_bytes)
+# ---------------------------------------------------------
+# マージ集計（上位）の表示
+# ---------------------------------------------------------
+merge_top = st.session_state.get("merge_top")
+if merge_top and merge_top["room_id"] == room_id and merge_top["months"] == selected_months:
+    st.markdown(
+        "<h3 style='text-align:center; color:#111827; margin-top:0; margin-bottom:4px; line-height:1.2; font-size:18px;'>"
+        f"マージ集計（上位{MERGE_TOP_N}位）</h3>",
+        unsafe_allow_html=True
+    )
 
-                month_text.markdown(
-                    f"<p style='font-size:14px; color:#10b981;'><b>{month} の取得完了 ({len(fans_data)} 件)</b></p>",
-                    unsafe_allow_html=True
-                )
-                month_progress.progress(1.0)
-
-            agg_df = None
-            if all_fans_data:
-                st.markdown(
-                    f"<div style='background-color:#f3f4f6; padding:10px; border-radius:10px; margin-bottom:10px;'>"
-                    f"<h2 style='font-size:20px; color:#111827;'>マージファイル作成処理</h2>"
-                    f"<p style='font-size:12px; color:#dc2626; font-weight:bold; margin-top:0;'>※退会ユーザーはマージデータには含まれません</p>"
-                    f"</div>",
-                    unsafe_allow_html=True
-                )
-                merge_progress = st.progress(0)
-                merge_text = st.empty()
-
-                merge_df = pd.DataFrame(all_fans_data)
-                merge_df = merge_df.iloc[::-1]
-                agg_df = merge_df.groupby('user_id', as_index=False).agg({
-                    'level': 'sum',
-                    'avatar_id': 'first',
-                    'user_name': 'first',
-                    'orig_order': 'first'
-                })
-                agg_df['title_id'] = (agg_df['level'] // 5).astype(int)
-                agg_df = agg_df[['avatar_id','level','title_id','user_id','user_name','orig_order']]
-                agg_df = agg_df.sort_values(by=['level','orig_order'], ascending=[False, True]).reset_index(drop=True)
-
-                merge_csv_bytes = agg_df.drop(columns='orig_order').to_csv(index=False, encoding="utf-8-sig").encode("utf-8-sig")
-                zip_file.writestr(f"active_fans_{room_id}_merge.csv", merge_csv_bytes)
-
-                merge_progress.progress(1.0)
-                merge_text.markdown(
-                    f"<p style='font-size:14px; color:#10b981;'><b>マージCSV作成完了 ({len(agg_df)} 件)</b></p>",
-                    unsafe_allow_html=True
-                )
+    # 外側に70vhのスクロール用divを追加し、thにsticky（見出し固定）を適用
+    merge_th_style = "border-bottom:1px solid #ccc; padding:4px; text-align:center; position: sticky; top: 0; background-color: #f3f4f6; z-index: 1;"
+    with timed("マージ表の描画"):
+        show_paged_table(
+            merge_top["df"],
+            [
+                {"key": "順位", "label": "順位", "th_style": merge_th_style, "td_style": "text-align:center;"},
+                {"key": "avatar_id", "label": "アバター", "th_style": merge_th_style, "td_style": "text-align:center;", "format": "avatar"},
+                {"key": "level", "label": "レベル合計値", "th_style": merge_th_style, "td_style": "text-align:center;"},
+                {"key": "user_name", "label": "ユーザー名", "th_style": merge_th_style, "td_style": "text-align:left; padding-left:8px;"},
+            ],
+            key="merge_page",
+            page_size=MERGE_PAGE_SIZE,
+            header_row_style="background-color:#f3f4f6;",
+            wrapper_style="max-height: 70vh; overflow-y: auto; border-bottom: 1px solid #ccc;",
+        )
+    st.markdown(f"<p style='font-size:12px; text-align:left; margin-top:4px;'>※{MERGE_TOP_N}位まで表示しています</p>", unsafe_allow_html=True)
 
-            zip_file.close()
-            zip_buffer.seek(0)
-
-            if all_fans_data:
-                st.markdown("<div style='margin-top:20px;'></div>", unsafe_allow_html=True)
-                st.download_button(
-                    label="ZIPをダウンロード",
-                    data=zip_buffer,
-                    file_name=f"active_fans_{room_id}.zip",
-                    mime="application/zip",
-                    key="zip_download"
-                )
-            else:
-                st.warning("該当データがありませんでした。")
-
-            if agg_df is not None and not agg_df.empty:
-                display_df = agg_df.copy()
-                display_df['順位'] = 0
-                last_level = None
-                rank = 0
-                for i, row in display_df.iterrows():
-                    if row['level'] != last_level:
-                        rank = i + 1
-                        last_level = row['level']
-                    display_df.at[i, '順位'] = rank
-                display_df = display_df[display_df['順位'] <= 100]
-
-                display_df = display_df[['順位','avatar_id','level','user_name']]
-                display_df.rename(columns={
-                    'avatar_id': 'アバター',
-                    'level': 'レベル合計値',
-                    'user_name': 'ユーザー名'
-                }, inplace=True)
-
-                st.markdown(
-                    "<h3 style='text-align:center; color:#111827; margin-top:0; margin-bottom:4px; line-height:1.2; font-size:18px;'>"
-                    "マージ集計（上位100位）</h3>",
-                    unsafe_allow_html=True
+# ---------------------------------------------------------
+# 複数ルームのファン重複分析
+# ---------------------------------------------------------
+overlap_job = get_job_manager().get(st.session_state.get("overlap_job_id"))
+with st.expander("👥 複数ルームのファン重複分析", expanded=overlap_job is not None):
+    st.caption(f"上で選択した月の全ファンを各ルームについて取得し、共通するファンを集計します（最大 {MAX_OVERLAP_ROOMS} ルーム）。")
+    overlap_input = st.text_area("対象のルームID（カンマ・空白・改行区切り）:", placeholder="例: 154851, 123456, 234567",
+                                 key="overlap_room_ids")
+    if st.button("👥 ファンの重複を分析する", key="overlap_btn",
+                 disabled=overlap_job is not None and not overlap_job.finished):
+        from fan_overlap import parse_room_ids
+        from fan_tasks import overlap_task
+        overlap_rooms = parse_room_ids(overlap_input)
+        if len(overlap_rooms) < 2 or not selected_months:
+            st.warning("ルームIDを2件以上入力し、月を選択してください。")
+        elif len(overlap_rooms) > MAX_OVERLAP_ROOMS:
+            st.warning(f"一度に分析できるのは {MAX_OVERLAP_ROOMS} ルームまでです。")
+        else:
+            try:
+                denied = [] if st.session_state.is_admin else [r for r in overlap_rooms if r not in get_room_index()]
+            except Exception as e:
+                denied = None
+                st.error(f"認証リストの取得に失敗しました。管理者にご確認ください。 (Error: {e})")
+            if denied:
+                st.error(f"認証されていないルームIDが含まれています: {', '.join(denied)}")
+            elif denied is not None:
+                job = submit_job(
+                    "overlap", f"重複分析 {len(overlap_rooms)}ルーム（{len(selected_months)}か月）", overlap_task,
+                    room_ids=overlap_rooms, months=sorted(selected_months), incremental=incremental_mode
                 )
+                st.session_state.overlap_job_id = job.id
+                st.rerun()
 
-                # 外側に70vhのスクロール用divを追加し、thにsticky（見出し固定）を適用
-                table_html = "<div style='max-height: 70vh; overflow-y: auto; border-bottom: 1px solid #ccc;'>"
-                table_html += "<table style='width:100%; border-collapse:collapse;'>"
-                table_html += "<thead><tr style='background-color:#f3f4f6;'>"
-                for col in display_df.columns:
-                    # 見出しを固定するためのスタイル（position: sticky）を追加
-                    table_html += f"<th style='border-bottom:1px solid #ccc; padding:4px; text-align:center; position: sticky; top: 0; background-color: #f3f4f6; z-index: 1;'>{col}</th>"
-                table_html += "</tr></thead><tbody>"
-                for idx, row in display_df.iterrows():
-                    table_html += "<tr>"
-                    table_html += f"<td style='text-align:center;'>{row['順位']}</td>"
-                    table_html += f"<td style='text-align:center;'><img src='https://static.showroom-live.com/image/avatar/{row['アバター']}.png' width='40'></td>"
-                    table_html += f"<td style='text-align:center;'>{row['レベル合計値']}</td>"
-                    table_html += f"<td style='text-align:left; padding-left:8px;'>{row['ユーザー名']}</td>"
-                    table_html += "</tr>"
-                table_html += "</tbody></table></div>"
-
-                st.markdown(table_html, unsafe_allow_html=True)
-                st.markdown("<p style='font-size:12px; text-align:left; margin-top:4px;'>※100位まで表示しています</p>", unsafe_allow_html=True)
\ No newline at end of file
+    if overlap_job is not None and not overlap_job.finished:
+        st.info("⏳ 各ルームのデータを取得中です（進捗は上のジョブ一覧に表示されます）")
+    elif overlap_job is not None and overlap_job.status == JOB_FAILED:
+        st.error(f"重複分析に失敗しました: {overlap_job.error}")
+    elif overlap_job is not None:
+        from fan_overlap import matrix_csv, shared_csv
+        result = overlap_job.result
+        overlap = result["overlap"]
+        if pick_up(overlap_job):
+            st.session_state.telemetry = result["telemetry"]
+        st.markdown(
+            f"#### 対象: {', '.join(overlap.rooms)}"
+            f" <span style='font-size: 0.6em; color: gray;'>({', '.join(overlap_job.params['months'])})</span>",
+            unsafe_allow_html=True
+        )
+        for failed_room, failed_months in result["failed_months"].items():
+            st.error(f"ルーム {failed_room} の {', '.join(failed_months)} は取得できないデータがあります（重複は取得できた分で集計しています）")
+
+        col_m1, col_m2, col_m3 = st.columns(3)
+        all_member = overlap.count_distribution()
+        col_m1.metric("ルーム数", len(overlap.rooms))
+        col_m2.metric("延べユニークファン", f"{len(overlap):,}")
+        col_m3.metric("2ルーム以上のファン", f"{int(all_member.loc[all_member['共通ルーム数'] >= 2, '人数'].sum()):,}")
+
+        st.markdown("##### 🔢 ルーム間の共通ファン数")
+        show_ratio = st.toggle("人数の代わりに割合（行のルームのファンのうち列のルームにもいる割合 %）を表示",
+                               key="overlap_ratio")
+        st.dataframe(overlap.pairwise_ratio() if show_ratio else overlap.pairwise_counts(),
+                     use_container_width=True)
+        st.download_button("共通ファン数CSVをダウンロード", data=matrix_csv(overlap),
+                           file_name="fan_overlap_matrix.csv", mime="text/csv", key="overlap_matrix_csv")
+
+        st.markdown("##### 🤝 共通ファンのランキング")
+        col_o1, col_o2, col_o3 = st.columns([2, 1, 1])
+        with col_o1:
+            target_rooms = st.multiselect("集計するルーム", options=overlap.rooms, default=overlap.rooms,
+                                          key="overlap_target_rooms")
+        with col_o2:
+            base_room = st.selectbox("基準ルーム（このルームのファンに限る）", options=["指定なし"] + target_rooms,
+                                     key="overlap_base_room")
+        with col_o3:
+            min_rooms = st.number_input("共通ルーム数（以上）", min_value=1, max_value=max(len(target_rooms), 1),
+                                        value=min(2, max(len(target_rooms), 1)), step=1, key="overlap_min_rooms")
+        if target_rooms:
+            shared_df = overlap.shared_fans(rooms=target_rooms, min_rooms=min_rooms,
+                                            base_room=None if base_room == "指定なし" else base_room)
+            st.caption(f"{len(shared_df):,} 人（{len(target_rooms)} ルーム中 {min_rooms} ルーム以上に共通）"
+                       f"・上位 {MERGE_TOP_N} 件を表示")
+            st.dataframe(shared_df.head(MERGE_TOP_N), use_container_width=True, height=500, hide_index=True,
+                         column_config={"順位": st.column_config.NumberColumn("順位", format="%d 位")})
+            st.download_button("共通ファンランキングCSVをダウンロード", data=shared_csv(shared_df),
+                               file_name="fan_overlap_shared.csv", mime="text/csv", key="overlap_shared_csv")
+            with st.expander("共通ルーム数ごとの人数"):
+                st.dataframe(overlap.count_distribution(target_rooms), hide_index=True, use_container_width=True)
+
+# ---------------------------------------------------------
+# 直近の操作の計測結果
+# ---------------------------------------------------------
+if st.session_state.get("telemetry") is not None:
+    show_telemetry_panel(st.session_state.telemetry)
@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+import showroom_client
+from fan_bench import start_stub
+from fan_fetcher import fetch_headers, fetch_months
+from fan_throttle import AdaptiveController
+
+ROOM_ID = "1"
+MONTHS = {"202401": 230, "202402": 120, "202403": 0}
+PER_PAGE = 50
+
+
+def _users(ym, count):
+    return [{"avatar_id": i % 7, "level": count - i, "title_id": 1, "user_id": int(ym) * 1000 + i,
+             "user_name": f"ファン{i},\"{ym}\""} for i in range(count)]
+
+
+@pytest.fixture
+def stub():
+    server, base_url = start_stub()
+    server.RequestHandlerClass.rooms = {
+        ROOM_ID: {ym: [json.dumps(u, ensure_ascii=False) for u in _users(ym, count)] for ym, count in MONTHS.items()}
+    }
+    yield server.RequestHandlerClass, base_url
+    server.shutdown()
+    server.server_close()
+
+
+def _fetch_kwargs(base_url, stats=None):
+    # 制御器は設定ファイルに保存しない新しいものを使い、テスト間で学習結果を持ち越さない
+    return {"base_url": base_url, "controller": AdaptiveController(), "max_workers": 6,
+            "rate_per_sec": 1000.0, "stats": stats}
+
+
+def test_fetch_headers_returns_every_month(stub):
+    _, base_url = stub
+    headers, errors = fetch_headers(ROOM_ID, list(MONTHS), **_fetch_kwargs(base_url))
+    assert errors == {}
+    assert {ym: data["count"] for ym, data in headers.items()} == MONTHS
+
+
+def test_fetch_months_returns_every_user_in_offset_order(stub):
+    _, base_url = stub
+    pages = []
+    records, failed = fetch_months(ROOM_ID, MONTHS, per_page=PER_PAGE,
+                                   on_page=lambda ym, offset, recs: pages.append((ym, offset, len(recs))),
+                                   **_fetch_kwargs(base_url))
+    assert failed == []
+    for ym, count in MONTHS.items():
+        assert list(records[ym]) == _users(ym, count)
+    # 各月のページが1回ずつ通知される
+    assert sorted(pages) == sorted((ym, offset, min(PER_PAGE, count - offset))
+                                   for ym, count in MONTHS.items() for offset in range(0, count, PER_PAGE))
+
+
+@pytest.mark.parametrize("status", [429, 500, 503])
+def test_fetch_months_retries_throttled_responses(stub, status):
+    handler, base_url = stub
+    handler.failures[(ROOM_ID, "202401", 100)] = [status, status]
+    stats = showroom_client.new_stats()
+    records, failed = fetch_months(ROOM_ID, MONTHS, per_page=PER_PAGE, **_fetch_kwargs(base_url, stats))
+    assert failed == []
+    assert list(records["202401"]) == _users("202401", MONTHS["202401"])
+    assert stats["retries"] == 2
+
+
+def test_fetch_months_reports_page_that_keeps_failing(stub):
+    handler, base_url = stub
+    # 再試行と取り直しをすべて使い切る回数だけ 500 を返す
+    handler.failures[(ROOM_ID, "202402", 50)] = [500] * 100
+    records, failed = fetch_months(ROOM_ID, MONTHS, per_page=PER_PAGE, **_fetch_kwargs(base_url))
+    assert [f[:3] for f in failed] == [("202402", 50, PER_PAGE)]
+    assert isinstance(failed[0][3], Exception)
+    expected = _users("202402", MONTHS["202402"])
+    assert list(records["202402"]) == expected[:50] + expected[100:]
+    assert list(records["202401"]) == _users("202401", MONTHS["202401"])